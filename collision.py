@@ -0,0 +1,290 @@
+# collision.py -- Capsule based collision checking for kinematic chains
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+# 
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+"""Capsule based collision checking
+
+Run as
+
+    python collision.py
+
+to check the segment, point and box distances against known values.
+"""
+
+__all__ = ['Sphere', 'Capsule', 'Box', 'make_obstacle', 'BVH',
+           'CollisionChecker', 'segment_distance']
+
+import numpy as np
+
+# the joint primitives drawn by ui.py have a radius of 0.02, twice that
+# of the link cylinders
+link_radius = 0.02
+
+def _dot(u, v):
+    return (u * v).sum(-1)
+
+def segment_distance(p1, q1, p2, q2):
+    '''Distances between the segments p1-q1 and p2-q2, vectorized over the
+    leading dimensions of the (... x 3) endpoint arrays.'''
+    d1 = q1 - p1
+    d2 = q2 - p2
+    r = p1 - p2
+    a = _dot(d1, d1)
+    e = _dot(d2, d2)
+    f = _dot(d2, r)
+    c = _dot(d1, r)
+    b = _dot(d1, d2)
+    tiny = 1e-12
+    denom = a * e - b * b
+    # closest points of the infinite lines, clamped to the first segment
+    s = np.where(denom > tiny, (b * f - c * e) / np.maximum(denom, tiny), 0.0)
+    s = np.clip(s, 0.0, 1.0)
+    t = np.where(e > tiny, (b * s + f) / np.maximum(e, tiny), 0.0)
+    # clamp t and recompute s for it
+    t_clamped = np.clip(t, 0.0, 1.0)
+    s = np.where(t != t_clamped,
+                 np.clip(np.where(a > tiny,
+                                  (b * t_clamped - c) / np.maximum(a, tiny),
+                                  0.0), 0.0, 1.0), s)
+    t = t_clamped
+    # second segment degenerate to a point: closest point on the first
+    point = e <= tiny
+    s = np.where(point, np.clip(np.where(a > tiny, -c / np.maximum(a, tiny),
+                                         0.0), 0.0, 1.0), s)
+    t = np.where(point, 0.0, t)
+    d = (p1 + d1 * s[..., np.newaxis]) - (p2 + d2 * t[..., np.newaxis])
+    return np.sqrt(_dot(d, d))
+
+def point_box_distance(p, lo, hi):
+    d = np.maximum(np.maximum(lo - p, p - hi), 0.0)
+    return np.sqrt(_dot(d, d))
+
+def segment_box_distance(p, q, lo, hi, iterations=24):
+    '''Distances between segments and an axis aligned box by golden
+    section search along the segments (the distance is convex there).'''
+    g = (np.sqrt(5) - 1) / 2
+    a = np.zeros(p.shape[:-1])
+    b = np.ones(p.shape[:-1])
+    d = q - p
+    for i in range(iterations):
+        c1 = b - g * (b - a)
+        c2 = a + g * (b - a)
+        f1 = point_box_distance(p + d * c1[..., np.newaxis], lo, hi)
+        f2 = point_box_distance(p + d * c2[..., np.newaxis], lo, hi)
+        left = f1 < f2
+        b = np.where(left, c2, b)
+        a = np.where(left, a, c1)
+    return np.minimum(point_box_distance(p + d * ((a + b) / 2)[..., np.newaxis],
+                                         lo, hi),
+                      np.minimum(point_box_distance(p, lo, hi),
+                                 point_box_distance(q, lo, hi)))
+
+class Capsule(object):
+
+    def __init__(self, a, b, radius):
+        self.a = np.asarray(a, dtype=np.float64)
+        self.b = np.asarray(b, dtype=np.float64)
+        self.radius = radius
+        self.lo = np.minimum(self.a, self.b) - radius
+        self.hi = np.maximum(self.a, self.b) + radius
+
+    def distance(self, p, q):
+        '''Distances from the segments p-q to the surface.'''
+        return segment_distance(p, q, self.a, self.b) - self.radius
+
+class Sphere(Capsule):
+
+    def __init__(self, center, radius):
+        Capsule.__init__(self, center, center, radius)
+
+class Box(object):
+    '''Axis aligned box between the corners lo and hi.'''
+
+    def __init__(self, lo, hi):
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.hi = np.asarray(hi, dtype=np.float64)
+
+    def distance(self, p, q):
+        return segment_box_distance(p, q, self.lo, self.hi)
+
+def make_obstacle(spec):
+    '''Obstacle from a robodef style tuple: ('sphere', center, radius),
+    ('capsule', a, b, radius) or ('box', lo, hi).'''
+    kind = spec[0]
+    return {'sphere': Sphere, 'capsule': Capsule, 'box': Box}[kind](*spec[1:])
+
+class BVH(object):
+    '''Bounding volume hierarchy of axis aligned boxes around obstacles.
+
+    query() takes a stack of boxes and returns, per obstacle, the boxes
+    overlapping it, descending only into nodes that some box overlaps.'''
+
+    leafsize = 2
+
+    def __init__(self, obstacles):
+        self.obstacles = list(obstacles)
+        self.root = None
+        if self.obstacles:
+            self.root = self._build(range(len(self.obstacles)))
+
+    def _build(self, index):
+        lo = np.min([self.obstacles[i].lo for i in index], axis=0)
+        hi = np.max([self.obstacles[i].hi for i in index], axis=0)
+        if len(index) <= self.leafsize:
+            return (lo, hi, list(index), None)
+        centers = np.array([(self.obstacles[i].lo + self.obstacles[i].hi) / 2
+                            for i in index])
+        axis = np.argmax(hi - lo)
+        order = np.argsort(centers[:, axis])
+        index = [index[i] for i in order]
+        mid = len(index) // 2
+        return (lo, hi, None, (self._build(index[:mid]),
+                               self._build(index[mid:])))
+
+    def query(self, lo, hi):
+        '''lo and hi are (M x 3) box corners; yields (obstacle, indices of
+        the overlapping boxes).'''
+        if self.root is None:
+            return
+        stack = [(self.root, np.arange(len(lo)))]
+        while stack:
+            (node_lo, node_hi, leaf, children), index = stack.pop()
+            overlap = ((lo[index] <= node_hi).all(1) &
+                       (hi[index] >= node_lo).all(1))
+            index = index[overlap]
+            if not len(index):
+                continue
+            if leaf is not None:
+                for i in leaf:
+                    obstacle = self.obstacles[i]
+                    hit = ((lo[index] <= obstacle.hi).all(1) &
+                           (hi[index] >= obstacle.lo).all(1))
+                    if hit.any():
+                        yield obstacle, index[hit]
+            else:
+                stack.append((children[0], index))
+                stack.append((children[1], index))
+
+class CollisionChecker(object):
+    '''Self and environment collision checks of a robot.
+
+    Every segment is approximated by a capsule of the given radius from
+    its base to the base of the next segment (the link cylinders drawn by
+    ui.py, the last one ending at the end effector).  Non-adjacent
+    capsules are checked against each other, except pairs found to
+    collide in almost every sampled configuration (for instance capsules
+    meeting at zero-length segments); all capsules are checked against
+    the obstacles through a BVH.'''
+
+    def __init__(self, robot, obstacles=(), radius=link_radius, samples=500):
+        self.robot = robot
+        self.radius = radius
+        self.set_obstacles(obstacles)
+        n = robot.model.nr_of_segments
+        pairs = [(i, j) for i in range(n) for j in range(i + 2, n)]
+        self.pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+        if len(self.pairs) and samples:
+            self._drop_always_colliding(samples)
+
+    def _drop_always_colliding(self, samples):
+        robot = self.robot
+        dof = robot.model.nr_of_joints
+        lo, hi = robot.joint_bounds()
+        q = np.random.RandomState(0).uniform(lo, hi, (samples, dof))
+        hits = self._pair_hits(robot.batch_fk(q, links=True)
+                               .reshape(samples, -1, 4, 4))
+        self.pairs = self.pairs[hits.mean(0) < .95]
+
+    def set_obstacles(self, obstacles):
+        self.obstacles = [o for o in obstacles]
+        self.bvh = BVH(self.obstacles)
+
+    def _pair_hits(self, poses):
+        p = poses[:, :, :3, 3]
+        i, j = self.pairs[:, 0], self.pairs[:, 1]
+        d = segment_distance(p[:, i], p[:, i + 1], p[:, j], p[:, j + 1])
+        return d < 2 * self.radius
+
+    def batch_check(self, q, self_collision=True):
+        '''True for each configuration of the (N x dof) array q in
+        collision.'''
+        q = np.asarray(q, dtype=np.float64).reshape(-1,
+                                                    self.robot.model.nr_of_joints)
+        return self.check_poses(self.robot.batch_fk(q, links=True)
+                                .reshape(len(q), -1, 4, 4), self_collision)
+
+    def check_poses(self, poses, self_collision=True):
+        '''Like batch_check for an (N x n+1 x 4 x 4) stack of segment
+        poses as returned by the batch FK.'''
+        poses = np.asarray(poses).reshape(-1, self.robot.model.nr_of_segments
+                                          + 1, 4, 4)
+        collides = np.zeros(len(poses), dtype=bool)
+        if self_collision and len(self.pairs):
+            collides |= self._pair_hits(poses).any(1)
+        if self.obstacles:
+            p = poses[:, :, :3, 3]
+            a = p[:, :-1].reshape(-1, 3)
+            b = p[:, 1:].reshape(-1, 3)
+            # broad phase on the capsules' bounding boxes
+            lo = np.minimum(a, b) - self.radius
+            hi = np.maximum(a, b) + self.radius
+            links = p.shape[1] - 1
+            for obstacle, index in self.bvh.query(lo, hi):
+                hit = obstacle.distance(a[index], b[index]) < self.radius
+                collides[index[hit] // links] = True
+        return collides
+
+    def collides(self, q=None):
+        '''Whether configuration q (the robot's current one by default)
+        is in collision.'''
+        if q is None:
+            poses = self.robot.poses
+        else:
+            poses = self.robot.model.poses(q)
+        return bool(self.check_poses(poses[np.newaxis])[0])
+
+def _check():
+    failed = False
+    cases = [
+        ('segment/point', Sphere([0, 0, 0], .1).distance(
+            np.array([-1., 0, 0]), np.array([1., 0, 0])), -.1),
+        ('point/segment', segment_distance(
+            np.array([0., 1, 0]), np.array([0., 1, 0]),
+            np.array([-1., 0, 0]), np.array([1., 0, 0])), 1.0),
+        ('point/point', segment_distance(
+            np.array([0., 0, 0]), np.array([0., 0, 0]),
+            np.array([0., 3, 4]), np.array([0., 3, 4])), 5.0),
+        ('crossing segments', segment_distance(
+            np.array([-1., 0, 0]), np.array([1., 0, 0]),
+            np.array([0., -1, 1]), np.array([0., 1, 1])), 1.0),
+        ('parallel segments', segment_distance(
+            np.array([0., 0, 0]), np.array([1., 0, 0]),
+            np.array([2., 1, 0]), np.array([3., 1, 0])), np.sqrt(2)),
+        ('segment/box', Box([1, 1, -1], [2, 2, 1]).distance(
+            np.array([0., 0, 0]), np.array([0., 3, 0])), 1.0),
+        ('segment through box', Box([-1, -1, -1], [1, 1, 1]).distance(
+            np.array([-2., 0, 0]), np.array([2., 0, 0])), 0.0),
+        ]
+    for name, d, expected in cases:
+        ok = abs(d - expected) < 1e-6
+        print '%-20s %9.6f %s' % (name, d, ok and 'ok' or
+                                  'FAILED (expected %g)' % expected)
+        failed = failed or not ok
+    return not failed
+
+if __name__ == '__main__':
+    import sys
+    if not _check():
+        sys.exit(1)
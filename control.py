@@ -0,0 +1,407 @@
+# control.py -- Fixed rate joint state control loop
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+#
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['Scheduler', 'StateBuffer', 'ControlLoop', 'IKWorker']
+
+from collections import deque
+import numpy as np
+from timing import monotonic, NullTimer
+from ports import YarpTransport, LATEST
+from record import QIN, QVIN, QOUT
+import threading
+import time
+
+class Scheduler(object):
+    '''Paces a loop to absolute deadlines period [s] apart on the
+    monotonic clock, so the period does not drift with the loop's run
+    time.
+
+    A cycle that ends after the next deadline is an overrun; the loop
+    then runs again at once to catch up, unless it is more than
+    catch_up periods behind, in which case the missed cycles are
+    skipped.'''
+
+    def __init__(self, period, catch_up=5):
+        self.period = period
+        self.catch_up = catch_up
+        self.deadline = None
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+
+    def wait(self):
+        '''Wait for the next deadline; returns the number of periods the
+        coming cycle has to account for (more than one after skipping).'''
+        now = monotonic()
+        steps = 1
+        if self.deadline is None:
+            self.deadline = now
+        elif now < self.deadline:
+            time.sleep(self.deadline - now)
+        else:
+            lateness = now - self.deadline
+            self.overruns += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+            missed = int(lateness / self.period)
+            if missed > self.catch_up:
+                self.skipped += missed
+                self.deadline += missed * self.period
+                steps += missed
+        self.deadline += self.period
+        self.cycles += 1
+        return steps
+
+    def __repr__(self):
+        return ('Scheduler(period=%.2fms, cycles=%d, overruns=%d, '
+                'skipped=%d, max_lateness=%.2fms)' % (
+                    self.period * 1000, self.cycles, self.overruns,
+                    self.skipped, self.max_lateness * 1000))
+
+class _Buffer(object):
+
+    def __init__(self, q):
+        self.seq = 0
+        self.q = np.array(q, dtype=np.float64)
+        self.command = 0
+        self.time = 0.0
+
+class StateBuffer(object):
+    '''Double buffered joint state handed from one writer thread to any
+    number of readers without locks.
+
+    The writer fills the back buffer and then flips it to the front.  A
+    buffer's sequence number is -1 while it is written, so a reader that
+    raced with the writer sees the number change and reads again.'''
+
+    def __init__(self, q):
+        self._buffers = [_Buffer(q), _Buffer(q)]
+        self._front = 0
+        self._seq = 0
+
+    def publish(self, q, command=0, stamp=None):
+        '''Make q the latest state at time stamp (now by default); command
+        is the id of the last command applied to it.'''
+        self._seq += 1
+        buf = self._buffers[1 - self._front]
+        buf.seq = -1
+        buf.q[:] = q
+        buf.command = command
+        if stamp is None:
+            stamp = time.time()
+        buf.time = stamp
+        buf.seq = self._seq
+        self._front = 1 - self._front
+
+    def read(self):
+        '''Return (seq, q, command) of the latest state.'''
+        while True:
+            buf = self._buffers[self._front]
+            seq = buf.seq
+            if seq < 0:
+                continue
+            q, command = buf.q.copy(), buf.command
+            if buf.seq == seq:
+                return seq, q, command
+
+class ControlLoop(threading.Thread):
+    '''Owns the joint state and serves the ports of a transport (by
+    default a ports.YarpTransport) at a fixed rate [s], independently
+    of rendering.
+
+    Cycles are paced by a Scheduler.  Every cycle writes the joint
+    positions to qout, reads positions from qin and velocities from
+    qvin, plays back planned motions, clamps to the limits, integrates
+    the velocities over the fixed period and publishes the result to
+    state.  Only the newest message on an input counts, except that with
+    qvin_mode ALL all velocities received in a cycle are applied in
+    order, each for an equal share of the period, or for the durations
+    in the input's holds where it has them (see record.ReplayTransport).
+
+    Other threads change the joint positions through command() and
+    play(); the id returned by command() shows up in the published
+    state once the command has been applied.  Joint vectors arriving on
+    the goal port are passed to on_goal.  Setting timing to a
+    timing.PhaseTimer times the phases of the cycles.
+
+    With a recorder (a record.LogWriter) the vectors applied from qin and
+    qvin and those written to qout are logged.  A transport with a
+    tick(dt) method (such as record.ReplayTransport) is ticked at the
+    start of every cycle and returns the time step [s] the cycle
+    integrates over, on the transport's clock.  With free_running the
+    cycles run back to back instead of at the rate, and the loop ends
+    once stop_when() is true.'''
+
+    def __init__(self, q, rate=0.02, limits_min=None, limits_max=None,
+                 transport=None, qvin_mode=LATEST):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.q = np.array(q, dtype=np.float64)
+        self.vels = np.zeros(len(self.q))
+        self.rate = rate
+        self.limits_min = limits_min
+        self.limits_max = limits_max
+        self.state = StateBuffer(self.q)
+        self.scheduler = Scheduler(rate)
+        self.timing = NullTimer()
+        self.player = None
+        self.on_goal = None
+        self.cycles = 0
+        self._commands = deque()
+        self._command_id = 0
+        self._command_lock = threading.Lock()
+        self._applied = 0
+        self._running = False
+        if transport is None:
+            transport = YarpTransport()
+        self.transport = transport
+        self._advance = getattr(transport, 'tick', None)
+        self.recorder = None
+        self.free_running = False
+        self.stop_when = None
+        self.xout = None
+        self.xin = None
+        self.ik_worker = None
+        n = len(self.q)
+        self.qin = transport.input('qin', n)
+        self.qvin = transport.input('qvin', n, qvin_mode)
+        self.qout = transport.output('qout', n)
+        self.goalin = transport.input('goal', n)
+
+    def enable_xout(self, model, all_frames=False):
+        '''Publish the end effector pose for the joint positions of every
+        cycle on the xout port, with all_frames preceded by the base poses
+        of all segments of model (a robot.ChainModel).
+
+        A message is the time stamp of the cycle followed by the top three
+        rows of each 4x4 pose, row by row.'''
+        self.model = model
+        self.all_frames = all_frames
+        n = all_frames and model.nr_of_segments + 1 or 1
+        self.xout = self.transport.output('xout', 1 + 12 * n)
+        self._x = np.empty(1 + 12 * n)
+        self._link_poses = None
+        self._link_poses_q = self.q.copy()
+
+    def enable_xin(self, robot):
+        '''Solve the end effector poses arriving on the xin port with
+        robot (a robot.Robot of its own) on an IKWorker thread.  A
+        message holds the top three rows of the 4x4 pose, row by row;
+        the worker reports on the xstatus port.'''
+        self.xin = self.transport.input('xin', 12)
+        self.ik_worker = IKWorker(robot, self,
+                                  self.transport.output('xstatus', 4))
+        self.ik_worker.start()
+
+    def _write_xout(self, stamp):
+        # recompute only downstream of the first joint that moved
+        self._link_poses = self.model.update_link_poses(
+            self.q, self._link_poses_q, self._link_poses)
+        self._link_poses_q[:] = self.q
+        if self.all_frames:
+            poses = self.model.segment_poses(self._link_poses)
+        else:
+            poses = self._link_poses[-1:]
+        self._x[0] = stamp
+        self._x[1:] = poses[:, :3, :].ravel()
+        self.xout.write(self._x)
+
+    def command(self, q):
+        '''Set the joint positions to q, stopping any playback; returns the
+        command id.'''
+        q = np.array(q)
+        # several threads command, so ids must be unique and queued in order
+        self._command_lock.acquire()
+        try:
+            self._command_id += 1
+            command_id = self._command_id
+            self._commands.append((command_id, q))
+        finally:
+            self._command_lock.release()
+        return command_id
+
+    def play(self, player):
+        '''Play back a planner.PathPlayer.'''
+        self.player = player
+
+    def tick(self, dt):
+        '''Run one cycle advancing the state by dt [s].'''
+        mark = self.timing.mark
+        if self._advance is not None:
+            dt = self._advance(dt)
+        recorder = self.recorder
+        # write current position
+        self.qout.write(self.q)
+        if recorder is not None:
+            recorder.append(QOUT, self.q)
+        mark('qout')
+
+        # apply commands from other threads
+        while self._commands:
+            self._applied, self.q[:] = self._commands.popleft()
+            self.player = None
+        mark('commands')
+
+        # read motion planning goal
+        goal = self.goalin.read()
+        if goal is not None and self.on_goal is not None:
+            self.on_goal(goal)
+        mark('goal')
+
+        # play back planned motion
+        player = self.player
+        if player is not None:
+            self.q[:] = player.step(dt)
+            if player.done():
+                self.player = None
+        mark('playback')
+
+        # hand the newest end effector target to the IK worker
+        if self.xin is not None:
+            x = self.xin.read()
+            if x is not None:
+                self.ik_worker.submit(x)
+            mark('xin')
+
+        # read commanded position
+        q = self.qin.read()
+        if q is not None:
+            self.player = None
+            self.q[:] = q
+            if recorder is not None:
+                recorder.append(QIN, q)
+        mark('qin')
+
+        # read commanded velocities, several sharing the cycle
+        step = dt
+        vels = self.qvin.read()
+        if self.qvin.mode == LATEST:
+            vels = vels is not None and [vels] or []
+        if recorder is not None:
+            for v in vels:
+                recorder.append(QVIN, v)
+        if vels:
+            holds = getattr(self.qvin, 'holds', None)
+            if holds is None:
+                holds = [0.0] + [dt / len(vels)] * len(vels)
+            self.q += self.vels * holds[0]
+            for v, hold in zip(vels[:-1], holds[1:-1]):
+                self.q += v * hold
+            self.vels[:] = vels[-1]
+            step = holds[-1]
+        mark('qvin')
+
+        # handle limits
+        if self.limits_min is not None and self.limits_max is not None:
+            np.clip(self.q, self.limits_min, self.limits_max, self.q)
+        mark('limits')
+
+        # apply velocities
+        self.q += self.vels * step
+        stamp = time.time()
+        self.state.publish(self.q, self._applied, stamp)
+        self.cycles += 1
+        mark('publish')
+
+        # write frames
+        if self.xout is not None:
+            self._write_xout(stamp)
+            mark('xout')
+
+    def run(self):
+        self._running = True
+        while self._running:
+            # integrate on the fixed period, whole periods after skipping
+            steps = 1
+            if not self.free_running:
+                steps = self.scheduler.wait()
+            self.timing.begin()
+            self.tick(steps * self.rate)
+            if self.stop_when is not None and self.stop_when():
+                break
+
+    def stop(self):
+        self._running = False
+        if self.isAlive():
+            self.join()
+
+class IKWorker(threading.Thread):
+    '''Solves end effector targets with robot.solve off the control
+    thread, starting from the latest state of control, and commands the
+    solutions to it.
+
+    A target submitted while another one waits replaces it, so bursts
+    coalesce to the newest target.  After every solve status (an output
+    of a transport, if any) gets the vector success (1 or 0), latency
+    [s] since submission, residual and iterations.'''
+
+    def __init__(self, robot, control, status=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.robot = robot
+        self.control = control
+        self.status = status
+        self.latency = None
+        self.solved = 0
+        self.failed = 0
+        self.coalesced = 0
+        self._target = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def submit(self, x):
+        '''Queue the target given as the top three rows of its pose.'''
+        target = np.identity(4)
+        target[:3] = np.reshape(x, (3, 4))
+        self._lock.acquire()
+        try:
+            if self._target is not None:
+                self.coalesced += 1
+            self._target = target, monotonic()
+        finally:
+            self._lock.release()
+        self._ready.set()
+
+    def run(self):
+        while True:
+            self._ready.wait()
+            self._lock.acquire()
+            try:
+                job, self._target = self._target, None
+                self._ready.clear()
+            finally:
+                self._lock.release()
+            if job is None:
+                continue
+            target, submitted = job
+            seq, q, command = self.control.state.read()
+            result = self.robot.solve(target, q)
+            if result.success:
+                self.control.command(result.q)
+                self.solved += 1
+            else:
+                self.failed += 1
+            self.latency = monotonic() - submitted
+            if self.status is not None:
+                self.status.write([float(result.success), self.latency,
+                                   result.residual, result.iterations])
+
+    def __repr__(self):
+        latency = self.latency is None and -1 or self.latency * 1000
+        return ('IKWorker(solved=%d, failed=%d, coalesced=%d, '
+                'latency=%.2fms)' % (self.solved, self.failed,
+                                     self.coalesced, latency))
@@ -21,7 +21,8 @@
 # not, see <http://www.gnu.org/licenses/>.
 
 __all__ = ['Display', 'MatrixTransform', 'rotate_x', 'rotate_y', 'rotate_z',
-           'scale', 'translate', 'arrow', 'cylinder', 'sphere', 'cube']
+           'scale', 'translate', 'arrow', 'cylinder', 'sphere', 'cube',
+           'point_cloud']
 
 from vtk import *
 from math import pi
@@ -157,6 +158,7 @@ class Display(object):
             actor.GetProperty().SetOpacity(opacity)
         self.ren.AddActor(actor)
         self.mappers.append((mapper, name))
+        return actor
 
     def pick(self, x, y):
         picker = vtkCellPicker()
@@ -250,3 +252,23 @@ def translate(x, y, z, source):
     transform.Translate(x, y, z)
     return filter_from_transform(transform, source)
 
+
+class PolyDataSource(object):
+
+    def __init__(self, poly_data):
+        self.poly_data = poly_data
+
+    def GetOutput(self):
+        return self.poly_data
+
+def point_cloud(points):
+    vtk_points = vtkPoints()
+    verts = vtkCellArray()
+    for i, (x, y, z) in enumerate(points):
+        vtk_points.InsertNextPoint(x, y, z)
+        verts.InsertNextCell(1)
+        verts.InsertCellPoint(i)
+    poly_data = vtkPolyData()
+    poly_data.SetPoints(vtk_points)
+    poly_data.SetVerts(verts)
+    return PolyDataSource(poly_data)
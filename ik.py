@@ -0,0 +1,458 @@
+# ik.py -- Inverse kinematics solvers for RoboView
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+# 
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['IKResult', 'NRSolver', 'NRJLSolver', 'DLSSolver', 'solvers',
+           'IKCache', 'SeedIndex', 'MultiStartIK', 'pose_error', 'jacobian',
+           'damped_step', 'solve_path']
+
+from PyKDL import *
+from robot import TRANS_X, Robot, make_segments, array_to_frame
+from kdtree import KDTree
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import time
+import os
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+def pose_error(pose, target):
+    '''Six vector from pose to target: translation followed by the
+    rotation vector, both in base coordinates.'''
+    e = np.empty(6)
+    e[:3] = target[:3, 3] - pose[:3, 3]
+    r = np.dot(target[:3, :3], pose[:3, :3].T)
+    w = np.array([r[2, 1] - r[1, 2], r[0, 2] - r[2, 0], r[1, 0] - r[0, 1]])
+    s = np.sqrt(np.dot(w, w)) / 2
+    c = (r[0, 0] + r[1, 1] + r[2, 2] - 1) / 2
+    angle = np.arctan2(s, c)
+    if s > 1e-9:
+        e[3:] = w * (angle / (2 * s))
+    elif c > 0:
+        e[3:] = w / 2
+    else:
+        # half a turn: the axis is the column of r + I with largest norm
+        m = r + np.identity(3)
+        k = np.argmax((m * m).sum(0))
+        e[3:] = m[:, k] / np.sqrt(np.dot(m[:, k], m[:, k])) * np.pi
+    return e
+
+def jacobian(model, poses):
+    '''Geometric jacobian of a chain model at the configuration with the
+    given link poses.'''
+    jac = np.zeros((6, model.nr_of_joints))
+    tip = poses[-1][:3, 3]
+    for link in model.jnt_link:
+        type = model.link_types[link]
+        n = model.link_joint[link]
+        axis = poses[link][:3, type % 3] * model.link_scales[link]
+        if type < TRANS_X:
+            jac[:3, n] = np.cross(axis, tip - poses[link][:3, 3])
+            jac[3:, n] = axis
+        else:
+            jac[:3, n] = axis
+    return jac
+
+def damped_step(jac, e, damping):
+    '''Damped least squares joint step reducing the pose error e.'''
+    a = np.dot(jac, jac.T) + damping ** 2 * np.identity(len(e))
+    return np.dot(jac.T, np.linalg.solve(a, e))
+
+class IKResult(object):
+    '''Outcome of one solve: the best configuration found, whether it
+    reached the target, and the iterations, residual and wall-clock time
+    spent.'''
+
+    def __init__(self, q, success, iterations, residual, time):
+        self.q = q
+        self.success = success
+        self.iterations = iterations
+        self.residual = residual
+        self.time = time
+
+    def __repr__(self):
+        return ('IKResult(success=%s, iterations=%d, residual=%.3g, '
+                'time=%.2fms)' % (self.success, self.iterations,
+                                  self.residual, self.time * 1000))
+
+class IKSolver(object):
+    '''Common part of the solvers.
+
+    solve(seed, target) takes the seed configuration and the target as a
+    4x4 pose and returns an IKResult.  A solve gives up after maxiter
+    iterations or, with a budget, after that many seconds, and then
+    returns the best configuration found so far.'''
+
+    def __init__(self, robot, eps=1e-5, maxiter=100, budget=None):
+        self.robot = robot
+        self.model = robot.model
+        self.dof = robot.model.nr_of_joints
+        self.eps = eps
+        self.maxiter = maxiter
+        self.budget = budget
+        self.limits_min = robot.limits_min
+        self.limits_max = robot.limits_max
+        self.last = None
+
+    def residual(self, q, target):
+        e = pose_error(self.model.link_poses(q)[-1], target)
+        return np.sqrt(np.dot(e, e))
+
+    def clamp(self, q):
+        if self.limits_min is not None:
+            np.clip(q, self.limits_min, self.limits_max, q)
+        return q
+
+class NRSolver(IKSolver):
+    '''KDL's Newton-Raphson solver, run in chunks of a few iterations so
+    the wall-clock budget can be checked in between; iterations are
+    counted in whole chunks.'''
+
+    chunk = 10
+
+    def __init__(self, robot, eps=1e-5, maxiter=100, budget=None):
+        IKSolver.__init__(self, robot, eps, maxiter, budget)
+        self._q_in = JntArray(self.dof)
+        self._q_out = JntArray(self.dof)
+        self._chunk = min(self.chunk, maxiter)
+        self._solver = self._make_solver(self._chunk)
+
+    def _make_solver(self, maxiter):
+        return ChainIkSolverPos_NR(self.robot.chain, self.robot.fk_solver,
+                                   self.robot.ikv_solver, maxiter, self.eps)
+
+    def solve(self, seed, target):
+        start = time.time()
+        frame = array_to_frame(target)
+        q = self.clamp(np.array(seed, dtype=np.float64))
+        best, best_residual = q, self.residual(q, target)
+        iterations = 0
+        success = False
+        while iterations < self.maxiter and not success:
+            for n in range(self.dof):
+                self._q_in[n] = q[n]
+            success = self._solver.CartToJnt(self._q_in, frame,
+                                             self._q_out) >= 0
+            iterations += self._chunk
+            q = np.array([self._q_out[n] for n in range(self.dof)])
+            residual = self.residual(q, target)
+            if success or residual < best_residual:
+                best, best_residual = q, residual
+            if self.budget is not None and time.time() - start > self.budget:
+                break
+        self.last = IKResult(best, success, iterations, best_residual,
+                             time.time() - start)
+        return self.last
+
+class NRJLSolver(NRSolver):
+    '''KDL's joint limit aware Newton-Raphson solver.'''
+
+    def __init__(self, robot, eps=1e-5, maxiter=100, budget=None):
+        if robot.limits_min is None or robot.limits_max is None:
+            raise ValueError('the nr_jl IK solver needs joint limits')
+        NRSolver.__init__(self, robot, eps, maxiter, budget)
+
+    def _make_solver(self, maxiter):
+        q_min = JntArray(self.dof)
+        q_max = JntArray(self.dof)
+        for n in range(self.dof):
+            q_min[n] = self.limits_min[n]
+            q_max[n] = self.limits_max[n]
+        return ChainIkSolverPos_NR_JL(self.robot.chain, q_min, q_max,
+                                      self.robot.fk_solver,
+                                      self.robot.ikv_solver,
+                                      maxiter, self.eps)
+
+class DLSSolver(IKSolver):
+    '''Damped least squares (Levenberg-Marquardt) solver working on the
+    robot's compiled chain model, clamping every step to the joint
+    limits.'''
+
+    def __init__(self, robot, eps=1e-5, maxiter=100, budget=None,
+                 damping=1e-2):
+        IKSolver.__init__(self, robot, eps, maxiter, budget)
+        self.damping = damping
+
+    def solve(self, seed, target):
+        start = time.time()
+        q = self.clamp(np.array(seed, dtype=np.float64))
+        poses = self.model.link_poses(q)
+        e = pose_error(poses[-1], target)
+        residual = np.sqrt(np.dot(e, e))
+        damping = self.damping
+        iterations = 0
+        while residual > self.eps and iterations < self.maxiter:
+            if self.budget is not None and time.time() - start > self.budget:
+                break
+            iterations += 1
+            q_new = self.clamp(q + damped_step(jacobian(self.model, poses),
+                                               e, damping))
+            poses_new = self.model.link_poses(q_new)
+            e_new = pose_error(poses_new[-1], target)
+            residual_new = np.sqrt(np.dot(e_new, e_new))
+            if residual_new < residual:
+                q, poses, e, residual = q_new, poses_new, e_new, residual_new
+                damping = max(damping / 2, 1e-6)
+            else:
+                damping *= 4
+        self.last = IKResult(q, residual <= self.eps, iterations, residual,
+                             time.time() - start)
+        return self.last
+
+solvers = {
+    'nr': NRSolver,
+    'nr_jl': NRJLSolver,
+    'dls': DLSSolver}
+
+def solve_path(solver, targets, seed):
+    '''Solve the 4x4 targets in order, seeding each from the previous
+    solution (or the last successful one after a failure).  Returns the
+    (N x dof) configurations and a boolean success array.'''
+    q = np.empty((len(targets), solver.dof))
+    ok = np.zeros(len(targets), dtype=bool)
+    for i, target in enumerate(targets):
+        result = solver.solve(seed, target)
+        q[i] = result.q
+        ok[i] = result.success
+        if result.success:
+            seed = result.q
+    return q, ok
+
+class IKCache(object):
+    '''Bounded LRU cache of IK results.
+
+    Results are keyed on the target pose and the seed configuration,
+    quantized to pos_tol (translation), rot_tol (rotation matrix
+    entries) and seed_tol (joint values), so repeated requests within
+    these tolerances return the stored result.  The least recently used
+    entry is evicted once size entries are stored.'''
+
+    def __init__(self, size=256, pos_tol=1e-4, rot_tol=1e-3, seed_tol=1e-3):
+        self.size = size
+        self.pos_tol = pos_tol
+        self.rot_tol = rot_tol
+        self.seed_tol = seed_tol
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def key(self, seed, target):
+        target = np.asarray(target)
+        return (tuple(np.round(target[:3, 3] / self.pos_tol).astype(int)),
+                tuple(np.round(target[:3, :3].ravel() /
+                               self.rot_tol).astype(int)),
+                tuple(np.round(np.asarray(seed) / self.seed_tol).astype(int)))
+
+    def get(self, seed, target):
+        '''Return the cached result for seed and target, or None.'''
+        key = self.key(seed, target)
+        result = self._entries.pop(key, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries[key] = result
+        return result
+
+    def put(self, seed, target, result):
+        key = self.key(seed, target)
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+        self._entries[key] = result
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+class SeedIndex(object):
+    '''Sampled joint configurations indexed by their end effector pose.
+
+    The joint space is sampled uniformly within the robot's limits (joints
+    without limits within [-pi, pi]) and the end effector poses are put
+    into a k-d tree over the position and the x and z axes scaled by
+    rot_weight, so nearest(target) yields the configurations whose poses
+    are closest to target as IK seeds.'''
+
+    def __init__(self, q, poses, rot_weight=0.1):
+        self.q = q
+        self.rot_weight = rot_weight
+        self.tree = KDTree(self.features(poses))
+
+    def features(self, poses):
+        poses = np.asarray(poses).reshape(-1, 4, 4)
+        return np.hstack([poses[:, :3, 3],
+                          self.rot_weight * poses[:, :3, 0],
+                          self.rot_weight * poses[:, :3, 2]])
+
+    def nearest(self, target, k=3):
+        dist, index = self.tree.query(self.features(target)[0], k)
+        return self.q[index]
+
+    def __len__(self):
+        return len(self.q)
+
+    def sample(cls, robot, samples=20000, rot_weight=0.1, seed=None):
+        dof = robot.model.nr_of_joints
+        lo, hi = robot.joint_bounds()
+        q = np.random.RandomState(seed).uniform(lo, hi, (samples, dof))
+        return cls(q, robot.batch_fk(q), rot_weight)
+
+    sample = classmethod(sample)
+
+    def load_or_sample(cls, robot, path, samples=20000, rot_weight=0.1):
+        '''Load the index stored at path or sample and store a new one.
+
+        The file records a digest of the chain and the sampling
+        parameters and is resampled when they no longer match.'''
+        digest = hashlib.md5(robot.chain_digest() +
+                             repr((samples, rot_weight))).hexdigest()
+        if os.path.exists(path):
+            try:
+                data = np.load(path)
+                if str(data['digest']) == digest:
+                    return cls(data['q'], data['poses'], rot_weight)
+            except (IOError, KeyError, ValueError):
+                pass
+        index = cls.sample(robot, samples, rot_weight)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez(path, q=index.q, poses=robot.batch_fk(index.q),
+                 digest=digest)
+        return index
+
+    load_or_sample = classmethod(load_or_sample)
+
+# robots built by this process when serving as a MultiStartIK worker,
+# keyed by their chain description
+_worker_robots = {}
+
+def _worker_robot(chain, solver, budget):
+    key, types, scales, static, limits_min, limits_max, options = chain
+    robot = _worker_robots.get(key)
+    if robot is None:
+        robot = Robot(make_segments(types, scales, static),
+                      limits_min=limits_min, limits_max=limits_max)
+        _worker_robots[key] = robot
+    if robot.ik_name != solver or robot.ik.budget is None:
+        robot.set_ik(solver, **options)
+    robot.ik.budget = budget
+    return robot
+
+def _worker_solve(chain, solver, seed, target, budget):
+    return _worker_robot(chain, solver, budget).ik.solve(seed, target)
+
+def _worker_solve_path(chain, solver, seed, targets, budget):
+    return solve_path(_worker_robot(chain, solver, budget).ik, targets, seed)
+
+class MultiStartIK(object):
+    '''IK from several seeds at once on a reused pool of worker processes.
+
+    Every worker builds the KDL chain once from the robot's compiled
+    model and keeps it for later calls.  solve() starts one solve per
+    seed, padding the given seeds with random configurations up to
+    starts, and returns the first successful result (mode 'first') or
+    the one with the smallest residual (mode 'best') available before
+    the deadline; work still queued is cancelled.'''
+
+    def __init__(self, robot, workers=None, starts=None, deadline=0.05,
+                 mode='first', solver=None, **options):
+        if futures is None:
+            raise ImportError('MultiStartIK needs concurrent.futures '
+                              '(the futures package on Python 2)')
+        self.robot = robot
+        self.workers = workers
+        self.starts = starts or workers or 4
+        self.deadline = deadline
+        self.mode = mode
+        self.solver = solver or robot.ik_name
+        model = robot.model
+        self._chain = (id(self), model.types, model.scales, model.static,
+                       robot.limits_min, robot.limits_max, options)
+        self._pool = None
+        self._random = np.random.RandomState()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = futures.ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def seeds(self, seeds=()):
+        lo, hi = self.robot.joint_bounds()
+        seeds = list(seeds)
+        while len(seeds) < self.starts:
+            seeds.append(self._random.uniform(lo, hi))
+        return seeds
+
+    def solve(self, target, seeds=(), deadline=None):
+        start = time.time()
+        if deadline is None:
+            deadline = self.deadline
+        pool = self._get_pool()
+        pending = set(pool.submit(_worker_solve, self._chain, self.solver,
+                                  np.asarray(seed, dtype=np.float64),
+                                  target, deadline)
+                      for seed in self.seeds(seeds))
+        best = None
+        iterations = 0
+        while pending:
+            remaining = deadline - (time.time() - start)
+            if remaining <= 0:
+                break
+            done, pending = futures.wait(pending, remaining,
+                                         futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                iterations += result.iterations
+                if (best is None or (result.success and not best.success)
+                    or (result.success == best.success
+                        and result.residual < best.residual)):
+                    best = result
+            if best is not None and best.success and self.mode == 'first':
+                break
+        for future in pending:
+            future.cancel()
+        if best is None:
+            q = np.asarray(seeds[0] if len(seeds) else self.robot.q)
+            best = IKResult(q, False, 0, np.inf, 0.0)
+        best.iterations = iterations
+        best.time = time.time() - start
+        return best
+
+    def solve_paths(self, seeds, paths, budget=None):
+        '''Solve several paths (lists of 4x4 targets) in parallel with
+        solve_path, each from its own seed; returns the list of their
+        results.'''
+        if budget is None:
+            budget = self.robot.ik.budget
+        pool = self._get_pool()
+        jobs = [pool.submit(_worker_solve_path, self._chain, self.solver,
+                            np.asarray(seed, dtype=np.float64), path, budget)
+                for seed, path in zip(seeds, paths)]
+        return [job.result() for job in jobs]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -0,0 +1,147 @@
+# kdtree.py -- A small k-d tree for nearest neighbour queries
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+# 
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['KDTree', 'DynamicKDTree']
+
+import heapq
+import numpy as np
+
+class KDTree(object):
+    '''Static k-d tree over the rows of an (N x d) array.
+
+    Nodes split at the median of the dimension with the largest spread;
+    leaves hold up to leafsize points, which are compared against a
+    query with one vectorized distance computation.'''
+
+    def __init__(self, points, leafsize=16):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.leafsize = leafsize
+        self.index = np.arange(len(self.points))
+        # per node: split dimension (-1 for leaves), split value,
+        # children and the range of self.index covered
+        self._dim = []
+        self._val = []
+        self._children = []
+        self._range = []
+        if len(self.points):
+            self._build(0, len(self.points))
+
+    def _build(self, start, end):
+        node = len(self._dim)
+        self._dim.append(-1)
+        self._val.append(0.0)
+        self._children.append(None)
+        self._range.append((start, end))
+        if end - start <= self.leafsize:
+            return node
+        index = self.index[start:end]
+        points = self.points[index]
+        dim = int(np.argmax(points.max(0) - points.min(0)))
+        order = np.argsort(points[:, dim], kind='mergesort')
+        self.index[start:end] = index[order]
+        mid = (start + end) // 2
+        self._dim[node] = dim
+        self._val[node] = self.points[self.index[mid], dim]
+        left = self._build(start, mid)
+        right = self._build(mid, end)
+        self._children[node] = (left, right)
+        return node
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, x, k=1):
+        '''Return the distances and row indices of the k points nearest
+        to x, nearest first.'''
+        x = np.asarray(x, dtype=np.float64)
+        best = [] # max-heap of (-squared distance, row)
+        stack = []
+        if len(self.points):
+            stack.append((0, 0.0))
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+            dim = self._dim[node]
+            if dim < 0:
+                start, end = self._range[node]
+                index = self.index[start:end]
+                d = self.points[index] - x
+                d = (d * d).sum(1)
+                for dist, i in zip(d.tolist(), index.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, i))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, i))
+                continue
+            diff = x[dim] - self._val[node]
+            left, right = self._children[node]
+            if diff < 0:
+                near, far = left, right
+            else:
+                near, far = right, left
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        best.sort(reverse=True)
+        return (np.sqrt([-d for d, i in best]),
+                np.array([i for d, i in best], dtype=np.intp))
+
+class DynamicKDTree(object):
+    '''Nearest neighbour index that grows one point at a time.
+
+    Points are kept in a KDTree plus a short tail of recent insertions
+    that is searched by brute force; the tree is rebuilt once the tail
+    grows past half its size, so insertions stay cheap on average.'''
+
+    def __init__(self, dim, leafsize=16):
+        self.dim = dim
+        self.leafsize = leafsize
+        self.points = np.empty((64, dim))
+        self.size = 0
+        self._tree = KDTree(self.points[:0], leafsize)
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, point):
+        '''Add a point and return its index.'''
+        if self.size == len(self.points):
+            points = np.empty((2 * len(self.points), self.dim))
+            points[:self.size] = self.points[:self.size]
+            self.points = points
+        self.points[self.size] = point
+        self.size += 1
+        if self.size - len(self._tree) > len(self._tree) // 2 + 32:
+            self._tree = KDTree(self.points[:self.size], self.leafsize)
+        return self.size - 1
+
+    def nearest(self, x):
+        '''Return the distance to and the index of the point nearest to
+        x.'''
+        x = np.asarray(x, dtype=np.float64)
+        best, best_index = np.inf, -1
+        if len(self._tree):
+            d, i = self._tree.query(x, 1)
+            best, best_index = d[0], i[0]
+        start = len(self._tree)
+        if self.size > start:
+            d = self.points[start:self.size] - x
+            d = np.sqrt((d * d).sum(1))
+            i = np.argmin(d)
+            if d[i] < best:
+                best, best_index = d[i], start + i
+        return best, best_index
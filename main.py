@@ -21,7 +21,7 @@
 # not, see <http://www.gnu.org/licenses/>.
 """Roboview -- A Robot Viewer for KDL
 
-Usage: roboview [--nav3d-dev <dev>] <file> <prefix>
+Usage: roboview [options] <file> [<prefix>]
        roboview [--help]
 
 Where <file> is a python module specifying the robot's structure.
@@ -29,6 +29,51 @@ Where <file> is a python module specifying the robot's structure.
 Options:
 
   --help             Show this help message
+  --ik <solver>      IK solver: nr, nr_jl (default with joint limits)
+                     or dls
+  --ik-budget <ms>   Wall-clock budget of one IK solve (default 10)
+  --ik-seeds <n>     Retry failed IK solves from the nearest of <n>
+                     sampled configurations; the samples are kept in
+                     ~/.roboview/
+  --ik-workers <n>   Run the retries of failed IK solves from several
+                     seeds in parallel on <n> worker processes
+  --reach            Reject IK targets outside the reachability map
+                     built by reach.py for <file>
+  --reach-map <map>  Like --reach, reading the map from <map>
+  --collision        Reject IK solutions in self collision or colliding
+                     with the obstacles listed in <file>; motion plans
+                     avoid the same collisions
+  --plan-timeout <s> Give up motion planning after <s> seconds
+                     (default 5)
+  --plan-speed <v>   Joint speed [rad/s] of planned motions (default 0.5)
+  --rate <hz>        Rate of the control loop serving the ports, up to
+                     1000 (default 50)
+  --fps <hz>         Target frame rate of the display (default 12.5)
+  --headless         Only serve the ports, without loading the GUI
+  --qvin-all         Apply all velocities received on qvin in a cycle
+                     in order instead of only the newest
+  --binary           Write qout as one binary float64 vector instead of
+                     a bottle of doubles (the inputs take both)
+  --xout             Publish the end effector pose on the xout port
+  --xout-all         Publish the poses of all segments and the end
+                     effector on the xout port
+  --xin              Move the end effector to the poses arriving on the
+                     xin port, solving the IK on a thread of its own;
+                     the outcome goes to the xstatus port
+  --record <log>     Record the vectors applied from qin and qvin and
+                     those written to qout in <log> (see record.py)
+  --replay <log>     Replay qin and qvin from <log> instead of reading
+                     them from the ports; with --headless, quit at the
+                     end of the log
+  --replay-speed <f> Replay <f> times as fast as recorded (default 1)
+  --replay-seek <s>  Start the replay <s> seconds into the log
+  --replay-max-rate  Replay as fast as possible
+  --shm              Serve the ports as shared memory ring buffers for
+                     processes on this host instead of over YARP (see
+                     shm.py)
+  --timing <s>       Time the phases of the control and render loops,
+                     printing the statistics every <s> seconds (never
+                     with 0; key T prints them)
 
 Written by Jonathan Kleinehellefort <jk@molb.org>
 (c) 2008 Technische Universitaet Muenchen
@@ -37,34 +82,134 @@ Written by Jonathan Kleinehellefort <jk@molb.org>
 
 from math import pi, sqrt
 from robot import *
-from display import *
 import sys
 from PyKDL import Frame, Rotation, Vector
 import imp
+import getopt
 import threading
-from ui import RobotWidget
-
-import yarp
-yarp.Network.init()
+from collision import CollisionChecker, make_obstacle
+import reach
+from ik import IKCache, SeedIndex, MultiStartIK, solvers
+from planner import RRTConnect, PlannerThread, PathPlayer
+from control import ControlLoop
+from ports import LATEST, ALL, YarpTransport
+from timing import PhaseTimer, NullTimer
+import atexit
 
 import time,os
 
 prefix=""
+ik_solver = None
+ik_budget = 0.01 # [s]
+ik_seeds = 0
+ik_workers = 0
+reach_file = None
+collision = False
+plan_timeout = 5.0 # [s]
+plan_speed = 0.5 # [rad/s]
+rate = 0.02 # [s]
+frame_time = 0.08 # [s]
+headless = False
+qvin_mode = LATEST
+binary = False
+shm = False
+xout = None
+xin = False
+record_file = None
+replay_file = None
+replay_speed = 1.0
+replay_seek = 0.0
+replay_max_rate = False
+timing_interval = None # [s]
+
+def usage_error():
+    print >>sys.stderr, 'Invalid command line arguments!'
+    print >>sys.stderr
+    print >>sys.stderr, __doc__
+    sys.exit(1)
+
 # command-line parsing
-if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] == '--help'):
+try:
+    opts, args = getopt.getopt(sys.argv[1:], '',
+                               ['help', 'ik=', 'ik-budget=', 'ik-seeds=',
+                                'ik-workers=', 'reach', 'reach-map=',
+                                'collision', 'plan-timeout=',
+                                'plan-speed=', 'rate=', 'fps=',
+                                'headless', 'timing=', 'qvin-all',
+                                'binary', 'shm', 'xout', 'xout-all',
+                                'xin', 'record=', 'replay=',
+                                'replay-speed=', 'replay-seek=',
+                                'replay-max-rate'])
+except getopt.GetoptError:
+    usage_error()
+for opt, val in opts:
+    if opt == '--help':
+        print __doc__
+        sys.exit(0)
+    elif opt == '--ik':
+        if val not in solvers:
+            usage_error()
+        ik_solver = val
+    elif opt == '--ik-budget':
+        ik_budget = float(val) / 1000.0
+    elif opt == '--ik-seeds':
+        ik_seeds = int(val)
+    elif opt == '--ik-workers':
+        ik_workers = int(val)
+    elif opt == '--reach':
+        reach_file = ''
+    elif opt == '--reach-map':
+        reach_file = val
+    elif opt == '--collision':
+        collision = True
+    elif opt == '--plan-timeout':
+        plan_timeout = float(val)
+    elif opt == '--plan-speed':
+        plan_speed = float(val)
+    elif opt == '--rate':
+        if not 0 < float(val) <= 1000:
+            usage_error()
+        rate = 1.0 / float(val)
+    elif opt == '--fps':
+        if not float(val) > 0:
+            usage_error()
+        frame_time = 1.0 / float(val)
+    elif opt == '--headless':
+        headless = True
+    elif opt == '--qvin-all':
+        qvin_mode = ALL
+    elif opt == '--binary':
+        binary = True
+    elif opt == '--shm':
+        shm = True
+    elif opt == '--xout':
+        xout = 'ef'
+    elif opt == '--xout-all':
+        xout = 'all'
+    elif opt == '--xin':
+        xin = True
+    elif opt == '--record':
+        record_file = val
+    elif opt == '--replay':
+        replay_file = val
+    elif opt == '--replay-speed':
+        replay_speed = float(val)
+    elif opt == '--replay-seek':
+        replay_seek = float(val)
+    elif opt == '--replay-max-rate':
+        replay_max_rate = True
+    elif opt == '--timing':
+        timing_interval = float(val)
+if len(args) == 0:
     print __doc__
     sys.exit(0)
+elif len(args) == 1:
+    robodef_module = args[0]
+elif len(args) == 2:
+    robodef_module = args[0]
+    prefix= args[1]
 else:
-    if len(sys.argv) == 2:
-        robodef_module = sys.argv[1]
-    elif len(sys.argv) == 3:
-        robodef_module = sys.argv[1]
-        prefix= sys.argv[2]
-    else:
-        print >>sys.stderr, 'Invalid command line arguments!'
-        print >>sys.stderr
-        print >>sys.stderr, __doc__
-        sys.exit(1)
+    usage_error()
 
 print "ConfigFilename:", robodef_module
 robodef_module_path=reduce(lambda x,y: x+"/"+y, robodef_module.split("/")[:-1])
@@ -78,9 +223,6 @@ sys.path.append(robodef_module_path)
 
 robodef = imp.load_source('robodev', robodef_module)
 
-import gobject
-gobject.threads_init()
-
 def vec_smul(u, v):
     ux, uy, uz = u
     vx, vy, vz = v
@@ -138,11 +280,75 @@ class Movable(object):
 class World(object):
 
     def __init__(self):
-        self.robot = Robot(robodef.segments)
+        self.robot = Robot(robodef.segments,
+                           limits_min=getattr(robodef, 'limits_min', None),
+                           limits_max=getattr(robodef, 'limits_max', None))
+        # keep drags on unreachable targets from stalling the GUI
+        try:
+            self.robot.set_ik(ik_solver or getattr(robodef, 'ik_solver',
+                                                   self.robot.ik_name),
+                              budget=ik_budget)
+        except ValueError, e:
+            print >>sys.stderr, robodef_module + ':', e
+            sys.exit(1)
+        self.robot.ik_cache = IKCache()
+        if ik_seeds:
+            path = os.path.join(os.path.expanduser('~'), '.roboview',
+                                os.path.splitext(robodef_module_name)[0] +
+                                '.seeds.npz')
+            self.robot.seed_index = SeedIndex.load_or_sample(self.robot, path,
+                                                             ik_seeds)
+        if ik_workers:
+            self.robot.multistart = MultiStartIK(self.robot, ik_workers,
+                                                 deadline=5 * ik_budget)
+            atexit.register(self.robot.multistart.close)
+        if reach_file is not None:
+            path = reach_file or reach.default_path(robodef_module)
+            if not os.path.exists(path):
+                print 'no reachability map', path, '(run reach.py)'
+            else:
+                reach_map = reach.ReachabilityMap.load(path)
+                if reach_map.digest != self.robot.chain_digest():
+                    print 'reachability map', path, 'is out of date'
+                else:
+                    self.robot.reach_map = reach_map
+        self.obstacles = [make_obstacle(spec) for spec in
+                          getattr(robodef, 'obstacles', [])]
+        if collision:
+            self.robot.collision = CollisionChecker(self.robot,
+                                                    self.obstacles)
+        self.planner = RRTConnect(self.robot, self.robot.collision,
+                                  timeout=plan_timeout)
+        self.planning = PlannerThread(self.planner, self._plan_start,
+                                      self._plan_done)
+        self.planning.start()
+        self.control = None
         self.ef_ghost = Movable()
         self.grabbed = False
         self.set_ghost_to_ef()
 
+    def plan_to(self, goal):
+        '''Plan a motion to the joint positions goal in the background;
+        the path is played back by the control loop.  Returns at once,
+        so the control thread can call it for goals on the goal port.'''
+        self.control.play(None)
+        self.planning.submit(goal)
+
+    def _plan_start(self):
+        return self.control.state.read()[1]
+
+    def _plan_done(self, path, stats):
+        print 'plan:', stats
+        if path is not None:
+            self.control.play(PathPlayer(path, plan_speed))
+
+    def plan_to_ghost(self):
+        result = self.robot.solve(frame_to_array(self.ef_ghost.frame))
+        if not result.success:
+            print 'no IK solution for the ghost'
+            return
+        self.plan_to(result.q)
+
     def set_ghost_to_ef(self):
         self.ef_ghost.frame = self.robot.frame
 
@@ -188,11 +394,19 @@ class World(object):
 
 class Scene(object):
 
-    def __init__(self, robot): # XXX: try to remove arg
+    def __init__(self, robot, obstacles=()): # XXX: try to remove arg
         self.robot = RobotWidget(robot)
+        self.obstacles = [ObstacleWidget(o) for o in obstacles]
+        self.reach = None
+        if robot.reach_map is not None:
+            self.reach = ReachabilityWidget(robot.reach_map)
 
     def add_to(self, display):
         self.robot.add_to(display)
+        for obstacle in self.obstacles:
+            obstacle.add_to(display)
+        if self.reach is not None:
+            self.reach.add_to(display)
 
 class JointController(object):
 
@@ -205,7 +419,7 @@ class JointController(object):
         self.widget.rotate_handler = rotate_handler
 
     def update(self):
-        self.widget.update(self.joint.frame, self.joint.value)
+        self.widget.update(self.joint.pose, self.joint.value)
 
 class EfController(object):
 
@@ -217,18 +431,18 @@ class EfController(object):
         def translate_handler(dv):
             dv = vec_s(dv, -1)
             self.m.pre_translate(*dv)
-            if self.robot.try_move(self.m.frame):
+            if self.robot.stream_move(self.m.frame):
                 self.handle_change()
         self.widget.translate_handler = translate_handler
         def rotate_handler(dr):
             self.m.rot(dr, vec_abs(dr) * 3)
-            if self.robot.try_move(self.m.frame):
+            if self.robot.stream_move(self.m.frame):
                 self.handle_change()
         self.widget.rotate_handler = rotate_handler
 
     def update(self):
         self.m.frame = self.robot.frame
-        self.widget.update(self.robot.frame)
+        self.widget.update(self.robot.poses[-1])
 
 class RobotController(object):
 
@@ -286,13 +500,101 @@ class Controller(object):
         else:
             gobject.idle_add(_update)
 
-display = Display()
-
 # the world model
 world = World()
 
+if shm:
+    from shm import ShmTransport
+    transport = shm_transport = ShmTransport(prefix)
+else:
+    transport = YarpTransport(prefix, binary)
+if replay_file is not None:
+    from record import LogReader, ReplayTransport
+    transport = ReplayTransport(LogReader(replay_file), replay_speed,
+                                replay_seek, transport)
+    q = transport.initial()
+    if q is not None:
+        world.robot.q = q
+control = ControlLoop(world.robot.q, rate, world.robot.limits_min,
+                      world.robot.limits_max, transport, qvin_mode)
+if shm:
+    def close_transport():
+        # the control thread must not touch unmapped rings
+        control.stop()
+        shm_transport.close()
+    atexit.register(close_transport)
+if replay_file is not None:
+    control.free_running = replay_max_rate
+    if headless:
+        control.stop_when = transport.finished
+if record_file is not None:
+    from record import LogWriter
+    control.recorder = LogWriter(record_file, len(world.robot.q))
+    def close_recorder():
+        # the control thread must not append to a closed log
+        control.stop()
+        control.recorder.close()
+    atexit.register(close_recorder)
+control.on_goal = world.plan_to
+if xout is not None:
+    control.enable_xout(world.robot.model, xout == 'all')
+if xin:
+    # the IK worker thread gets a robot of its own
+    ik_robot = Robot(robodef.segments,
+                     limits_min=getattr(robodef, 'limits_min', None),
+                     limits_max=getattr(robodef, 'limits_max', None))
+    ik_robot.set_ik(world.robot.ik_name, budget=ik_budget)
+    ik_robot.ik_cache = IKCache()
+    ik_robot.seed_index = world.robot.seed_index
+    ik_robot.reach_map = world.robot.reach_map
+    if collision:
+        ik_robot.collision = CollisionChecker(ik_robot, world.obstacles)
+    control.enable_xin(ik_robot)
+world.control = control
+
+timers = []
+if timing_interval is not None:
+    control.timing = PhaseTimer(rate)
+    timers.append(('control loop', control.timing))
+
+def print_timing():
+    for title, timer in timers:
+        print timer.report(title)
+
+def print_timing_main():
+    while True:
+        time.sleep(timing_interval)
+        print_timing()
+
+if timing_interval:
+    timer_thread = threading.Thread(target=print_timing_main)
+    timer_thread.setDaemon(True)
+    timer_thread.start()
+
+if headless:
+    try:
+        control.run()
+    except KeyboardInterrupt:
+        pass
+    print 'control loop:', control.scheduler
+    if replay_file is not None:
+        print 'replayed %.3f s of %s' % (transport.position(), replay_file)
+    for port in control.qin, control.qvin, control.goalin:
+        print port
+    if control.ik_worker is not None:
+        print control.ik_worker
+    print_timing()
+    sys.exit(0)
+
+from display import *
+from ui import RobotWidget, ReachabilityWidget, ObstacleWidget
+import gobject
+gobject.threads_init()
+
+display = Display()
+
 # the scene graph
-scene = Scene(world.robot)
+scene = Scene(world.robot, world.obstacles)
 
 scene.add_to(display)
 
@@ -320,6 +622,32 @@ def handle_key(c):
     elif c == 's':
         world.set_ghost_to_ef()
         controller.update()
+    elif c == 'p':
+        world.plan_to_ghost()
+    elif c == 'm' and scene.reach is not None:
+        scene.reach.toggle()
+        display.redraw()
+    elif c == 'i':
+        cache = world.robot.ik_cache
+        print 'IK cache: %d entries, %d hits, %d misses' % (len(cache),
+                                                           cache.hits,
+                                                           cache.misses)
+        print 'last solve:', world.robot.ik_result
+        print 'drag steps: %d, position IK fallbacks: %d' % (
+            world.robot.stream_steps, world.robot.stream_fallbacks)
+        print 'targets rejected by the reachability map:', world.robot.rejected
+        print 'solutions rejected for collisions:', world.robot.collisions
+        print 'last plan:', world.planner.stats
+    elif c == 't':
+        if timers:
+            print_timing()
+        else:
+            print 'timing is off (see --timing)'
+        print 'control loop:', world.control.scheduler
+        for port in control.qin, control.qvin, control.goalin:
+            print port
+        if control.ik_worker is not None:
+            print control.ik_worker
 
 def enable_rotation(x, y, n):
     if n == 1:
@@ -369,75 +697,49 @@ def update_joints_main():
 
 #display.run()
 
-rate = 0.02 # [s]
-display_multiplier = 4
-
-qin=yarp.BufferedPortBottle()
-qin.open(prefix+"/roboview/qin")
-qvin=yarp.BufferedPortBottle()
-qvin.open(prefix+"/roboview/qvin")
-qout=yarp.BufferedPortBottle()
-qout.open(prefix+"/roboview/qout")
+control.start()
 
 display.show()
 
-finalTime = time.time()
-display_counter=0
+render_timing = NullTimer()
+if timers:
+    render_timing = PhaseTimer(frame_time)
+    timers.append(('render loop', render_timing))
+mark = render_timing.mark
 
-num_joints = world.robot.jnt_pos.rows()
-vels = [0]*num_joints
+# joint positions last taken from or sent to the control loop
+shown = world.robot.q
+sent = 0
+seq = 0
 
 while display.is_alive():
   initTime = time.time()
-  while display.busy() and (time.time() - initTime) < rate*0.8:
+  render_timing.begin()
+  while display.busy() and (time.time() - initTime) < frame_time*0.8:
     display.handle_event()
-
-  # write current position
-  bot=qout.prepare()
-  bot.clear()
-  for i in range(num_joints):
-    bot.addDouble(world.robot.jnt_pos[i])
-  qout.write()
-
-  # read commanded position
-  bottlein = qin.read(False)
-  if bottlein and bottlein.size() == num_joints:
-    for i in range(num_joints):
-      world.robot.jnt_pos[i] = bottlein.get(i).asDouble()
-
-  # read commanded velocities
-  bottlein = qvin.read(False)
-  if bottlein and bottlein.size() == num_joints:
-    for i in range(num_joints):
-      vels[i] = bottlein.get(i).asDouble()
-
-  # handle limits
-  if robodef.limits_min and robodef.limits_max:
-    for i in range (num_joints):
-     world.robot.jnt_pos[i] = min(robodef.limits_max[i],
-                               max(robodef.limits_min[i],
-                                world.robot.jnt_pos[i]))
-
-  # refresh display
-  if display_counter == display_multiplier:
-    display.redraw()
+  mark('events')
+
+  # hand changes made in the GUI to the control loop
+  q = world.robot.q
+  if (q != shown).any():
+    sent = control.command(q)
+    shown = q
+  mark('command')
+
+  # show the latest state once it includes our changes
+  latest, q, command = control.state.read()
+  if latest != seq and command >= sent:
+    seq = latest
+    world.robot.q = q
+    shown = q
+    mark('state')
     controller.update()
-    display_counter=0
-  else:
-    display_counter=display_counter+1
-
-  # apply velocities
-  factor = time.time()-finalTime
-  for i in range (num_joints):
-    world.robot.jnt_pos[i] = world.robot.jnt_pos[i] + vels[i]*factor
-  
-  #print "factor: "+str(factor)+" "+reduce(str.__add__,[str(v)+" " for v in vels])
-
-  # handle sleeping
-  finalTime = time.time()
-  sleepTime = rate - (finalTime - initTime)
+    mark('update')
+    display.redraw()
+    mark('redraw')
+
+  sleepTime = frame_time - (time.time() - initTime)
   if sleepTime>0:
     time.sleep(sleepTime)
 
-  initTime = time.time()
-
+control.stop()
@@ -0,0 +1,240 @@
+# planner.py -- Sampling based joint space motion planning
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+# 
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['RRTConnect', 'PlanStats', 'PlannerThread', 'PathPlayer']
+
+from kdtree import DynamicKDTree
+import numpy as np
+import threading
+import time
+
+class PlanStats(object):
+
+    def __init__(self):
+        self.success = False
+        self.time = 0.0
+        self.iterations = 0
+        self.nodes = 0
+        self.checks = 0
+        self.waypoints = 0
+
+    def __repr__(self):
+        return ('PlanStats(success=%s, time=%.1fms, iterations=%d, '
+                'nodes=%d, checks=%d, waypoints=%d)' % (
+                    self.success, self.time * 1000, self.iterations,
+                    self.nodes, self.checks, self.waypoints))
+
+class _Tree(object):
+
+    def __init__(self, dof, root):
+        self.index = DynamicKDTree(dof)
+        self.parents = []
+        self.add(root, -1)
+
+    def add(self, q, parent):
+        self.parents.append(parent)
+        return self.index.insert(q)
+
+    def path(self, i):
+        path = []
+        while i >= 0:
+            path.append(self.index.points[i].copy())
+            i = self.parents[i]
+        return path
+
+class RRTConnect(object):
+    '''Bidirectional RRT in joint space within the robot's limits.
+
+    Motions are straight lines in joint space, checked for collisions
+    with the robot's collision checker (if any) at points check_step
+    apart in one batch.  Trees grow by at most step (joint space
+    distance) per extension.'''
+
+    def __init__(self, robot, collision=None, step=0.2, check_step=0.05,
+                 max_nodes=20000, timeout=5.0, shortcuts=50, seed=None):
+        self.robot = robot
+        self.collision = collision
+        self.step = step
+        self.check_step = check_step
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+        self.shortcuts = shortcuts
+        self.random = np.random.RandomState(seed)
+        self.lo, self.hi = robot.joint_bounds()
+        self.stats = PlanStats()
+        self.cancelled = False
+
+    def valid(self, q):
+        self.stats.checks += 1
+        return self.collision is None or not self.collision.collides(q)
+
+    def valid_motion(self, a, b):
+        if self.collision is None:
+            return True
+        n = int(np.ceil(np.abs(b - a).max() / self.check_step))
+        if n < 1:
+            return True
+        t = np.linspace(0, 1, n + 1)[1:, np.newaxis]
+        self.stats.checks += n
+        return not self.collision.batch_check(a + t * (b - a)).any()
+
+    def _extend(self, tree, q):
+        '''Grow tree one step towards q; returns the new node, its index
+        and whether it reached q.'''
+        d, near = tree.index.nearest(q)
+        q_near = tree.index.points[near]
+        if d <= self.step:
+            q_new, reached = q, True
+        else:
+            q_new, reached = q_near + (q - q_near) * (self.step / d), False
+        if not self.valid_motion(q_near, q_new):
+            return None, -1, False
+        return q_new, tree.add(q_new, near), reached
+
+    def _connect(self, tree, q):
+        while True:
+            q_new, i, reached = self._extend(tree, q)
+            if q_new is None or reached:
+                return i, reached
+
+    def plan(self, start, goal):
+        '''Return a collision free path from start to goal as an (M x dof)
+        array of waypoints, or None; statistics are left in stats.'''
+        begin = time.time()
+        self.stats = stats = PlanStats()
+        self.cancelled = False
+        start = np.clip(np.asarray(start, dtype=np.float64), self.lo, self.hi)
+        goal = np.clip(np.asarray(goal, dtype=np.float64), self.lo, self.hi)
+        path = None
+        if self.valid(start) and self.valid(goal):
+            if self.valid_motion(start, goal):
+                path = [start, goal]
+            else:
+                path = self._search(start, goal, begin)
+        if path is not None:
+            path = self._shortcut(np.array(path))
+            stats.success = True
+            stats.waypoints = len(path)
+        stats.time = time.time() - begin
+        return path
+
+    def _search(self, start, goal, begin):
+        stats = self.stats
+        dof = len(start)
+        a, b = _Tree(dof, start), _Tree(dof, goal)
+        forward = a
+        while (len(a.parents) + len(b.parents) < self.max_nodes
+               and time.time() - begin < self.timeout
+               and not self.cancelled):
+            stats.iterations += 1
+            q = self.random.uniform(self.lo, self.hi)
+            q_new, i, reached = self._extend(a, q)
+            if q_new is not None:
+                j, connected = self._connect(b, q_new)
+                if connected:
+                    stats.nodes = len(a.parents) + len(b.parents)
+                    path = a.path(i)[::-1] + b.path(j)[1:]
+                    if a is not forward:
+                        path.reverse()
+                    return path
+            a, b = b, a
+        stats.nodes = len(a.parents) + len(b.parents)
+        return None
+
+    def _shortcut(self, path):
+        for k in range(self.shortcuts):
+            if len(path) < 3:
+                break
+            i, j = sorted(self.random.randint(len(path), size=2))
+            if j - i > 1 and self.valid_motion(path[i], path[j]):
+                path = np.vstack([path[:i + 1], path[j:]])
+        return path
+
+class PlannerThread(threading.Thread):
+    '''Plans with planner in the background, one goal at a time.
+
+    submit(goal) returns at once, cancelling the plan under way; the
+    newest goal submitted is planned next, from the configuration start()
+    returns when planning begins.  done(path, stats) gets the path (or
+    None) and the statistics of every plan not overtaken by a newer
+    goal.'''
+
+    def __init__(self, planner, start, done):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.planner = planner
+        self.start_q = start
+        self.done = done
+        self._goal = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def submit(self, goal):
+        self._lock.acquire()
+        try:
+            self._goal = np.array(goal, dtype=np.float64)
+            self.planner.cancelled = True
+        finally:
+            self._lock.release()
+        self._ready.set()
+
+    def run(self):
+        while True:
+            self._ready.wait()
+            self._lock.acquire()
+            try:
+                goal, self._goal = self._goal, None
+                self._ready.clear()
+            finally:
+                self._lock.release()
+            if goal is None:
+                continue
+            path = self.planner.plan(self.start_q(), goal)
+            self._lock.acquire()
+            try:
+                overtaken = self._goal is not None
+            finally:
+                self._lock.release()
+            if not overtaken:
+                self.done(path, self.planner.stats)
+
+class PathPlayer(object):
+    '''Plays a path of waypoints back with no joint moving faster than
+    max_velocity [rad/s].'''
+
+    def __init__(self, path, max_velocity=0.5):
+        self.path = np.asarray(path, dtype=np.float64)
+        self.max_velocity = max_velocity
+        self.segment = 0
+        self.t = 0.0
+
+    def done(self):
+        return self.segment >= len(self.path) - 1
+
+    def step(self, dt):
+        '''Advance by dt seconds and return the joint positions.'''
+        travel = self.max_velocity * dt
+        while not self.done():
+            a, b = self.path[self.segment], self.path[self.segment + 1]
+            length = np.abs(b - a).max()
+            if length - self.t > travel:
+                self.t += travel
+                return a + (b - a) * (self.t / length)
+            travel -= length - self.t
+            self.segment += 1
+            self.t = 0.0
+        return self.path[-1].copy()
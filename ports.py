@@ -0,0 +1,258 @@
+# ports.py -- YARP ports for joint vectors
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+#
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Joint vector ports
+
+Endpoints are opened through a transport: YarpTransport for YARP ports
+or shm.ShmTransport for shared memory between processes on one host.
+Both give endpoints with the same read() and write() methods.
+
+On YARP a joint vector travels either as a bottle of one double per
+joint or, in the binary format, as a bottle holding a single string
+with the raw little-endian float64 values.  Inputs accept both
+formats.
+
+Every message written carries a YARP envelope with its sequence number
+and send time, from which inputs keep latency statistics.
+
+Run as
+
+    python ports.py [--bench] [--rate <hz>] [--count <n>]
+
+to check both formats over a local loopback connection, or with --bench
+to measure the round trip latency of <n> vectors (default 1000) sent at
+<hz> (default 100) through a local echo.
+"""
+
+__all__ = ['LATEST', 'ALL', 'JointInput', 'JointOutput', 'YarpTransport',
+           'encode', 'decode']
+
+from timing import LatencyStats
+import numpy as np
+import time
+
+# imported on first use, so that other transports run without YARP
+yarp = None
+
+def _import_yarp():
+    global yarp
+    import yarp
+
+LATEST = 'latest'
+ALL = 'all'
+
+def encode(bottle, q, binary=False):
+    '''Fill bottle with the joint vector q.'''
+    bottle.clear()
+    if binary:
+        bottle.addString(np.asarray(q, dtype='<f8').tostring())
+    else:
+        for v in q:
+            bottle.addDouble(v)
+
+def decode(bottle, size):
+    '''Return the joint vector in bottle (a read-only array for the
+    binary format), or None if it does not hold size values.'''
+    if bottle.size() == 1 and bottle.get(0).isString():
+        data = bottle.get(0).asString()
+        if len(data) != 8 * size:
+            return None
+        return np.frombuffer(data, dtype='<f8')
+    if bottle.size() != size:
+        return None
+    return np.array([bottle.get(i).asDouble() for i in range(size)])
+
+class JointInput(object):
+    '''Input port for vectors of size joint values.
+
+    The port is strict, so YARP queues every message, and every read()
+    drains the messages pending.  In LATEST mode it returns only the
+    newest vector (or None), counting the older ones as dropped.  In ALL
+    mode it returns a list of the vectors in arrival order, skipping all
+    but the newest max_batch messages as stale so that a fast sender
+    cannot make the reader fall further and further behind.  Messages of
+    the wrong size count as invalid.  Both the bottle and the binary
+    format are accepted.  Envelopes of the messages feed latency (a
+    timing.LatencyStats), and stamp holds the sequence number and send
+    time of the last message read.'''
+
+    def __init__(self, name, size, mode=LATEST, max_batch=16):
+        self.size = size
+        self.mode = mode
+        self.max_batch = max_batch
+        _import_yarp()
+        self.port = yarp.BufferedPortBottle()
+        self.port.setStrict()
+        self.port.open(name)
+        self.received = 0
+        self.dropped = 0
+        self.stale = 0
+        self.invalid = 0
+        self.latency = LatencyStats()
+        self.stamp = None
+        self._envelope = yarp.Stamp()
+
+    def _decode(self, bottle):
+        v = decode(bottle, self.size)
+        if v is None:
+            self.invalid += 1
+        return v
+
+    def _read(self, count, keep):
+        '''Read count pending messages, decoding the newest keep.'''
+        vectors = []
+        now = time.time()
+        for i in range(count):
+            bottle = self.port.read(False)
+            if bottle is None:
+                break
+            self.received += 1
+            if self.port.getEnvelope(self._envelope):
+                self.stamp = (self._envelope.getCount(),
+                              self._envelope.getTime())
+                self.latency.add(self.stamp[0], self.stamp[1], now)
+            if i >= count - keep:
+                v = self._decode(bottle)
+                if v is not None:
+                    vectors.append(v)
+        return vectors
+
+    def read(self):
+        count = self.port.getPendingReads()
+        if self.mode == LATEST:
+            self.dropped += max(count - 1, 0)
+            vectors = self._read(count, 1)
+            if vectors:
+                return vectors[-1]
+            return None
+        self.stale += max(count - self.max_batch, 0)
+        return self._read(count, self.max_batch)
+
+    def __repr__(self):
+        return ('%s(received=%d, dropped=%d, stale=%d, invalid=%d, %r)' %
+                (self.port.getName(), self.received, self.dropped,
+                 self.stale, self.invalid, self.latency))
+
+class JointOutput(object):
+    '''Output port for joint vectors, in the binary format if binary.'''
+
+    def __init__(self, name, binary=False):
+        self.binary = binary
+        _import_yarp()
+        self.port = yarp.BufferedPortBottle()
+        self.port.open(name)
+        self.seq = 0
+
+    def write(self, q, stamp=None):
+        '''Send q in an envelope with the next sequence number and the
+        current time, or with stamp, a (sequence number, time) pair.'''
+        if stamp is None:
+            self.seq += 1
+            stamp = self.seq, time.time()
+        encode(self.port.prepare(), q, self.binary)
+        self.port.setEnvelope(yarp.Stamp(*stamp))
+        self.port.write()
+
+class YarpTransport(object):
+    '''Opens endpoints as YARP ports named <prefix>/roboview/<name>,
+    writing the binary format if binary.'''
+
+    def __init__(self, prefix='', binary=False):
+        _import_yarp()
+        yarp.Network.init()
+        self.prefix = prefix
+        self.binary = binary
+
+    def input(self, name, size, mode=LATEST):
+        return JointInput(self.prefix + '/roboview/' + name, size, mode)
+
+    def output(self, name, size):
+        return JointOutput(self.prefix + '/roboview/' + name, self.binary)
+
+def _check():
+    q = np.array([0.5, -1.25, np.pi, 1e-300, -0.0, 7.0])
+    inputs = {}
+    for mode in LATEST, ALL:
+        inputs[mode] = JointInput('/roboview/test/in/' + mode, len(q), mode)
+    failed = False
+    for binary in (False, True):
+        out = JointOutput('/roboview/test/out', binary)
+        for port in inputs.values():
+            yarp.Network.connect('/roboview/test/out', port.port.getName())
+        for k in range(3):
+            out.write(q + k)
+            time.sleep(0.05)
+        latest = inputs[LATEST].read()
+        batch = inputs[ALL].read()
+        ok = (latest is not None and (latest == q + 2).all() and
+              len(batch) == 3 and
+              all((v == q + k).all() for k, v in enumerate(batch)))
+        print '%s format: %s' % (binary and 'binary' or 'bottle',
+                                  ok and 'ok' or 'FAILED')
+        failed = failed or not ok
+        out.port.close()
+    return not failed
+
+def _bench(rate, count, size=7):
+    out = JointOutput('/roboview/bench/out')
+    echo_in = JointInput('/roboview/bench/echo/in', size, ALL)
+    echo_out = JointOutput('/roboview/bench/echo/out')
+    back = JointInput('/roboview/bench/in', size, ALL)
+    yarp.Network.connect('/roboview/bench/out', '/roboview/bench/echo/in')
+    yarp.Network.connect('/roboview/bench/echo/out', '/roboview/bench/in')
+    start = time.time()
+    for k in range(count):
+        out.write(np.zeros(size) + k)
+        # echo with the original envelope, so back sees the round trip
+        deadline = time.time() + 1.0
+        received = 0
+        while not received and time.time() < deadline:
+            for v in echo_in.read():
+                echo_out.write(v, echo_in.stamp)
+            received = len(back.read())
+        time.sleep(max(start + (k + 1.0) / rate - time.time(), 0))
+    print 'round trip at %g Hz:' % rate, back.latency
+    print 'one way:', echo_in.latency
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+    bench = False
+    rate = 100.0
+    count = 1000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+                                   ['help', 'bench', 'rate=', 'count='])
+    except getopt.GetoptError:
+        opts, args = [('--help', '')], []
+    for opt, val in opts:
+        if opt == '--help':
+            print __doc__
+            sys.exit(0)
+        elif opt == '--bench':
+            bench = True
+        elif opt == '--rate':
+            rate = float(val)
+        elif opt == '--count':
+            count = int(val)
+    _import_yarp()
+    yarp.Network.init()
+    yarp.Network.setLocalMode(True)
+    if bench:
+        _bench(rate, count)
+    elif not _check():
+        sys.exit(1)
@@ -0,0 +1,190 @@
+# reach.py -- Precomputed reachability maps of kinematic chains
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+# 
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+"""Build the reachability map of a robot definition
+
+Usage: python reach.py [--samples <n>] [--resolution <m>] <file> [<map>]
+
+Samples the joint space of the robot defined in <file> and stores the
+reachable voxels in <map> (by default ~/.roboview/<name>.reach), where
+roboview --reach picks it up.
+"""
+
+__all__ = ['ReachabilityMap', 'default_path']
+
+import numpy as np
+import struct
+import os
+
+_magic = 'RVREACH1'
+# magic, grid shape, origin, resolution, chain digest
+_header = struct.Struct('<8s3i4d32s')
+
+# the orientation of a pose is binned by the direction of its z axis
+# into the 26 directions towards the neighbours of a voxel
+_directions = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                        for z in (-1, 0, 1) if (x, y, z) != (0, 0, 0)],
+                       dtype=np.float64)
+_directions /= np.sqrt((_directions ** 2).sum(1))[:, np.newaxis]
+# directions within 60 degrees of each other, so that a bin accepts
+# targets between its direction and the neighbouring ones
+_near = np.dot(_directions, _directions.T) > .5
+_near_masks = np.array([sum(1 << int(j) for j in np.flatnonzero(row))
+                        for row in _near], dtype=np.uint32)
+
+def default_path(robodef_file):
+    name = os.path.splitext(os.path.basename(robodef_file))[0]
+    return os.path.join(os.path.expanduser('~'), '.roboview',
+                        name + '.reach')
+
+def _direction_bins(z):
+    return np.argmax(np.dot(z, _directions.T), axis=1)
+
+class ReachabilityMap(object):
+    '''Voxel grid of the positions the end effector can reach.
+
+    Every voxel holds a bit mask of the end effector z axis directions
+    (one bit per direction towards the 26 neighbouring voxels) seen
+    there while sampling.  The map is stored as a header followed by
+    the uint32 grid and is memory-mapped when loaded, so lookups are
+    O(1) without reading the whole file.'''
+
+    def __init__(self, grid, origin, resolution, digest=''):
+        self.grid = grid
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.resolution = resolution
+        self.digest = digest
+        self.shape = np.array(grid.shape)
+
+    def _index(self, p):
+        i = np.floor((np.asarray(p) - self.origin) / self.resolution)
+        return i.astype(int)
+
+    def reachable(self, target):
+        '''False if the 4x4 target pose is certainly out of reach.'''
+        i = self._index(target[:3, 3])
+        if (i < 0).any() or (i >= self.shape).any():
+            return False
+        mask = int(self.grid[i[0], i[1], i[2]])
+        if not mask:
+            return False
+        bin = _direction_bins(target[np.newaxis, :3, 2])[0]
+        return bool(mask & int(_near_masks[bin]))
+
+    def voxels(self):
+        '''Centers of the reachable voxels as an (N x 3) array.'''
+        return ((np.argwhere(self.grid) + .5) * self.resolution +
+                self.origin)
+
+    def build(cls, robot, samples=200000, resolution=0.05, chunk=10000,
+              seed=None):
+        '''Sample the joint space of robot (within its limits, [-pi, pi]
+        for joints without) and voxelize the end effector poses.  The
+        occupancy is grown by one voxel so that reachable targets between
+        samples are not rejected.'''
+        model = robot.model
+        dof = model.nr_of_joints
+        lo, hi = robot.joint_bounds()
+        # a bound on the reach: the lengths of all links plus the
+        # largest extension of the prismatic joints
+        radius = np.sqrt((model.base[:3, 3] ** 2).sum())
+        radius += np.sqrt((model.link_static[:, :3, 3] ** 2).sum(1)).sum()
+        for link in model.jnt_link:
+            if model.link_types[link] >= 3:
+                n = model.link_joint[link]
+                radius += abs(model.link_scales[link]) * max(abs(lo[n]),
+                                                             abs(hi[n]))
+        radius += 2 * resolution
+        size = int(np.ceil(2 * radius / resolution))
+        grid = np.zeros((size, size, size), dtype=np.uint32)
+        origin = -radius * np.ones(3)
+        random = np.random.RandomState(seed)
+        for start in range(0, samples, chunk):
+            q = random.uniform(lo, hi, (min(chunk, samples - start), dof))
+            poses = robot.batch_fk(q).reshape(-1, 4, 4)
+            i = np.floor((poses[:, :3, 3] - origin) /
+                         resolution).astype(int)
+            bits = (1 << _direction_bins(poses[:, :3, 2])).astype(np.uint32)
+            np.bitwise_or.at(grid, (i[:, 0], i[:, 1], i[:, 2]), bits)
+        for axis in range(3):
+            grown = grid.copy()
+            for shift in (-1, 1):
+                grown |= np.roll(grid, shift, axis)
+            grid = grown
+        return cls(grid, origin, resolution, robot.chain_digest())
+
+    build = classmethod(build)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(path, 'wb')
+        try:
+            f.write(_header.pack(_magic, *(list(self.grid.shape) +
+                                           list(self.origin) +
+                                           [self.resolution, self.digest])))
+            f.write(np.ascontiguousarray(self.grid, dtype='<u4').tostring())
+        finally:
+            f.close()
+
+    def load(cls, path):
+        f = open(path, 'rb')
+        try:
+            header = _header.unpack(f.read(_header.size))
+        finally:
+            f.close()
+        if header[0] != _magic:
+            raise IOError('%s is not a reachability map' % path)
+        shape, origin = header[1:4], header[4:7]
+        grid = np.memmap(path, dtype='<u4', mode='r', offset=_header.size,
+                         shape=shape)
+        return cls(grid, origin, header[7], header[8])
+
+    load = classmethod(load)
+
+if __name__ == '__main__':
+    import getopt
+    import imp
+    import sys
+    from robot import Robot
+    samples = 200000
+    resolution = 0.05
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+                                   ['help', 'samples=', 'resolution='])
+    except getopt.GetoptError:
+        opts, args = [('--help', '')], []
+    for opt, val in opts:
+        if opt == '--help':
+            print __doc__
+            sys.exit(0)
+        elif opt == '--samples':
+            samples = int(val)
+        elif opt == '--resolution':
+            resolution = float(val)
+    if len(args) not in (1, 2):
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+    robodef = imp.load_source('robodef', args[0])
+    robot = Robot(robodef.segments,
+                  limits_min=getattr(robodef, 'limits_min', None),
+                  limits_max=getattr(robodef, 'limits_max', None))
+    reach_map = ReachabilityMap.build(robot, samples, resolution)
+    path = len(args) == 2 and args[1] or default_path(args[0])
+    reach_map.save(path)
+    print 'wrote %s: %d of %d voxels reachable' % (
+        path, len(reach_map.voxels()), reach_map.grid.size)
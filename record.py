@@ -0,0 +1,289 @@
+# record.py -- Recording and replay of joint streams
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+#
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+"""Summarize a log of joint streams
+
+Usage: python record.py [--dump] <log>
+
+Prints the duration and number of vectors of every stream recorded with
+roboview --record in <log>, and with --dump every vector.
+
+A log is a header followed by preallocated records of float64 values:
+the time, the stream (QIN, QVIN or QOUT) and the joint vector.
+"""
+
+__all__ = ['QIN', 'QVIN', 'QOUT', 'LogWriter', 'LogReader',
+           'ReplayTransport']
+
+from ports import LATEST, ALL
+from timing import LatencyStats
+import numpy as np
+import struct
+import time
+
+QIN, QVIN, QOUT = 0, 1, 2
+streams = {'qin': QIN, 'qvin': QVIN, 'qout': QOUT}
+
+_magic = 'RVLOG001'
+# magic, size, capacity, count, start time, padding to 64 bytes
+_header = struct.Struct('<8s2iqd32x')
+
+# records this close to the replay clock [s] count as reached
+_tolerance = 1e-6
+
+class LogWriter(object):
+    '''Appends joint vectors of size values to the log at path, which is
+    preallocated for capacity records and memory mapped.  The record
+    count in the header is updated with every record, so the log stays
+    readable if RoboView dies; records beyond capacity are counted in
+    overflow and lost.'''
+
+    def __init__(self, path, size, capacity=1000000):
+        self.path = path
+        self.size = size
+        self.capacity = capacity
+        f = open(path, 'wb')
+        try:
+            f.write(_header.pack(_magic, size, capacity, 0, time.time()))
+            f.truncate(_header.size + capacity * (2 + size) * 8)
+        finally:
+            f.close()
+        self._map = np.memmap(path, dtype=np.uint8, mode='r+')
+        self._count = self._map[16:24].view('<i8')
+        self.records = self._map[_header.size:].view('<f8').reshape(
+            capacity, 2 + size)
+        self.count = 0
+        self.overflow = 0
+
+    def append(self, stream, q, stamp=None):
+        if self.count == self.capacity:
+            self.overflow += 1
+            return
+        if stamp is None:
+            stamp = time.time()
+        record = self.records[self.count]
+        record[0] = stamp
+        record[1] = stream
+        record[2:] = q
+        self.count += 1
+        self._count[0] = self.count
+
+    def close(self):
+        self._map.flush()
+        self._map = self._count = self.records = None
+
+class LogReader(object):
+    '''Read access to a log written by LogWriter: times, streams and
+    values of the records as arrays.'''
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            header = _header.unpack(f.read(_header.size))
+        finally:
+            f.close()
+        if header[0] != _magic:
+            raise IOError('%s is not a joint stream log' % path)
+        self.path = path
+        self.size, capacity, count, self.start = header[1:5]
+        self.records = np.memmap(path, dtype='<f8', mode='r',
+                                 offset=_header.size,
+                                 shape=(capacity, 2 + self.size))[:count]
+        self.times = self.records[:, 0]
+        self.streams = self.records[:, 1].astype(np.int8)
+        self.values = self.records[:, 2:]
+
+    def __len__(self):
+        return len(self.records)
+
+    def duration(self):
+        if not len(self):
+            return 0.0
+        return self.times[-1] - self.times[0]
+
+    def stream(self, stream):
+        '''Return the times and values of one stream.'''
+        index = np.flatnonzero(self.streams == stream)
+        return self.times[index], self.values[index]
+
+class _ReplayInput(object):
+    '''Counterpart of ports.JointInput delivering the recorded vectors of
+    one stream once the replay clock has reached their time, given as
+    offsets [s] into the log.
+
+    In ALL mode holds gives, for the cycle of the last read(), how long
+    [s] on the replay clock the previous vector and then each vector
+    read held before the next one was recorded or the cycle ended.'''
+
+    def __init__(self, replay, name, times, values, mode, max_batch=16):
+        self.replay = replay
+        self.name = name
+        self.times = times
+        self.values = values
+        self.mode = mode
+        self.max_batch = max_batch
+        self.next = np.searchsorted(times, replay.offset - _tolerance)
+        self.received = 0
+        self.dropped = 0
+        self.stale = 0
+        self.invalid = 0
+        self.latency = LatencyStats()
+        self.stamp = None
+        self.holds = None
+
+    def seek(self, offset):
+        self.next = np.searchsorted(self.times, offset - _tolerance)
+
+    def done(self):
+        return self.next >= len(self.times)
+
+    def read(self):
+        end = np.searchsorted(self.times, self.replay.offset + _tolerance,
+                              'right')
+        first, self.next = self.next, max(end, self.next)
+        count = self.next - first
+        self.received += count
+        if self.mode == LATEST:
+            if not count:
+                return None
+            self.dropped += count - 1
+            self.stamp = (self.next,
+                          self.replay.start + self.times[self.next - 1])
+            return np.array(self.values[self.next - 1])
+        if self.max_batch is not None and count > self.max_batch:
+            self.stale += count - self.max_batch
+            first = self.next - self.max_batch
+        if count:
+            self.stamp = (self.next,
+                          self.replay.start + self.times[self.next - 1])
+        end = self.replay.offset
+        begin = end - self.replay.step
+        times = np.clip(self.times[first:self.next], begin, end)
+        self.holds = np.diff(np.concatenate([[begin], times, [end]]))
+        return [np.array(v) for v in self.values[first:self.next]]
+
+    def __repr__(self):
+        return ('replay %s(received=%d, dropped=%d, stale=%d)' %
+                (self.name, self.received, self.dropped, self.stale))
+
+class _NullOutput(object):
+
+    def write(self, q, stamp=None):
+        pass
+
+class ReplayTransport(object):
+    '''Feeds the qin and qvin streams of a log to the control loop as if
+    they arrived on the ports.
+
+    The replay clock starts seek [s] into the log and advances by speed
+    times the period with every cycle (see tick), so with the control
+    loop free running the log replays as fast as the loop goes.  It is
+    kept as an offset from the first record, as the wall clock times in
+    the log are too coarse to add periods to.  Every recorded velocity
+    was applied, so qvin delivers them all whatever the mode asked for.
+    The other endpoints are opened on transport, or discarded if there is
+    none.'''
+
+    def __init__(self, log, speed=1.0, seek=0.0, transport=None):
+        self.log = log
+        self.speed = speed
+        self.transport = transport
+        self.start = len(log) and log.times[0] or 0.0
+        self.offset = seek
+        self.step = 0.0
+        self.inputs = []
+
+    def input(self, name, size, mode=LATEST):
+        if name not in ('qin', 'qvin'):
+            if self.transport is None:
+                return _ReplayInput(self, name, np.empty(0),
+                                    np.empty((0, size)), mode)
+            return self.transport.input(name, size, mode)
+        if size != self.log.size:
+            raise ValueError('%s holds vectors of %d values, not %d' %
+                             (self.log.path, self.log.size, size))
+        times, values = self.log.stream(streams[name])
+        if name == 'qvin':
+            port = _ReplayInput(self, name, times - self.start, values, ALL,
+                                None)
+        else:
+            port = _ReplayInput(self, name, times - self.start, values, mode)
+        self.inputs.append(port)
+        return port
+
+    def output(self, name, size):
+        if self.transport is None:
+            return _NullOutput()
+        return self.transport.output(name, size)
+
+    def tick(self, dt):
+        '''Advance the replay clock by one control cycle of dt [s];
+        returns the step of the replay clock, which the cycle integrates
+        over.'''
+        self.step = self.speed * dt
+        self.offset += self.step
+        return self.step
+
+    def seek(self, offset):
+        '''Continue the replay offset [s] into the log.'''
+        self.offset = offset
+        for port in self.inputs:
+            port.seek(offset)
+
+    def initial(self):
+        '''Joint positions last written to qout before the replay clock,
+        or None.'''
+        times, values = self.log.stream(QOUT)
+        i = np.searchsorted(times - self.start, self.offset + _tolerance,
+                            'right')
+        if not i:
+            return None
+        return np.array(values[i - 1])
+
+    def position(self):
+        return self.offset
+
+    def finished(self):
+        return all(port.done() for port in self.inputs)
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+    dump = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '', ['help', 'dump'])
+    except getopt.GetoptError:
+        opts, args = [('--help', '')], []
+    for opt, val in opts:
+        if opt == '--help':
+            print __doc__
+            sys.exit(0)
+        elif opt == '--dump':
+            dump = True
+    if len(args) != 1:
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+    log = LogReader(args[0])
+    print '%s: %d records of %d joints over %.3f s, started %s' % (
+        args[0], len(log), log.size, log.duration(), time.ctime(log.start))
+    for name in 'qin', 'qvin', 'qout':
+        times, values = log.stream(streams[name])
+        print '  %-4s %8d vectors' % (name, len(times))
+    if dump:
+        names = dict((v, k) for k, v in streams.items())
+        for t, stream, q in zip(log.times, log.streams, log.values):
+            print '%.6f %-4s %s' % (t - log.times[0], names[stream],
+                                    ' '.join(['%g' % v for v in q]))
@@ -19,18 +19,289 @@
 # General Public License for more details. You should have received a
 # copy of the GNU General Public License along with PyPlayerCGen.  If
 # not, see <http://www.gnu.org/licenses/>.
+"""Kinematic chain model
+
+Run as
+
+    python robot.py [<robodef> ...]
+
+to check the forward kinematics of the chain model against KDL's
+ChainFkSolverPos_recursive for the given robot definitions, or for those
+shipped with RoboView.
+"""
 
 from PyKDL import *
-from math import pi
+from math import pi, atan2, cos, sin
+import numpy as np
+import hashlib
+
+# joint type codes of the compiled chain model
+ROT_X, ROT_Y, ROT_Z, TRANS_X, TRANS_Y, TRANS_Z, FIXED = range(7)
+
+_type_to_code = {
+    Joint.RotX: ROT_X,
+    Joint.RotY: ROT_Y,
+    Joint.RotZ: ROT_Z,
+    Joint.TransX: TRANS_X,
+    Joint.TransY: TRANS_Y,
+    Joint.TransZ: TRANS_Z,
+    Joint.None: FIXED}
+
+_code_to_type = [Joint.RotX, Joint.RotY, Joint.RotZ,
+                 Joint.TransX, Joint.TransY, Joint.TransZ, Joint.None]
+
+_code_to_str = ['rot_x', 'rot_y', 'rot_z',
+                'trans_x', 'trans_y', 'trans_z', 'none']
+
+# rows mixed by a rotation about x, y and z
+_rot_rows = [(1, 2), (2, 0), (0, 1)]
+
+def frame_to_array(frame):
+    '''Return a KDL frame as a homogeneous 4x4 float64 array.'''
+    m = np.identity(4)
+    for i in range(3):
+        for j in range(3):
+            m[i, j] = frame.M[i, j]
+        m[i, 3] = frame.p[i]
+    return m
+
+def array_to_frame(m):
+    '''Return the KDL frame of a homogeneous 4x4 array.'''
+    return Frame(Rotation(m[0, 0], m[0, 1], m[0, 2],
+                          m[1, 0], m[1, 1], m[1, 2],
+                          m[2, 0], m[2, 1], m[2, 2]),
+                 Vector(m[0, 3], m[1, 3], m[2, 3]))
+
+def _joint_scale(joint):
+    '''Recover the scale of a joint from two of its poses.'''
+    d = joint.pose(0).Inverse() * joint.pose(1)
+    t = _type_to_code[joint.getType()]
+    if t == ROT_X:
+        return atan2(d.M[2, 1], d.M[1, 1])
+    elif t == ROT_Y:
+        return atan2(d.M[0, 2], d.M[0, 0])
+    elif t == ROT_Z:
+        return atan2(d.M[1, 0], d.M[0, 0])
+    elif t == FIXED:
+        return 0.0
+    return d.p[t - TRANS_X]
+
+def make_segments(types, scales, static):
+    '''KDL segments from the type codes, scales and static poses of a
+    ChainModel, e.g. to rebuild a robot in another process.'''
+    segments = []
+    for type, scale, pose in zip(types, scales, static):
+        if type == FIXED:
+            joint = Joint(Joint.None)
+        else:
+            joint = Joint(_code_to_type[type], scale)
+        segments.append(Segment(joint, array_to_frame(pose)))
+    return segments
+
+class ChainModel(object):
+    '''Array-backed kinematic chain compiled once from KDL segments.
+
+    static holds the pose at zero of every segment as an (n x 4 x 4)
+    float64 array, types the joint type codes, scales the joint scales,
+    jnt_segment maps joint numbers to segment indices and seg_joint maps
+    segment indices to joint numbers (-1 for fixed segments).  A segment
+    moved by x is the joint transform of scale * x times its static
+    pose.
+
+    The kinematics run on links.  With fold=True every run of fixed
+    segments is merged into the link of the preceding joint, or into
+    the base pose for a leading run, so there is one link per joint.
+    Without folding every segment is a link.  The base pose of segment i
+    is the base pose of link seg_link[i] times seg_offset[i].'''
+
+    def __init__(self, segments, fold=True):
+        n = len(segments)
+        self.static = np.empty((n, 4, 4))
+        self.types = np.empty(n, dtype=np.int8)
+        self.scales = np.zeros(n)
+        self.seg_joint = np.empty(n, dtype=np.intp)
+        jnt_segment = []
+        for i, seg in enumerate(segments):
+            joint = seg.getJoint()
+            self.types[i] = _type_to_code[joint.getType()]
+            self.static[i] = frame_to_array(seg.pose(0))
+            if self.types[i] == FIXED:
+                self.seg_joint[i] = -1
+            else:
+                self.seg_joint[i] = len(jnt_segment)
+                self.scales[i] = _joint_scale(joint)
+                jnt_segment.append(i)
+        self.jnt_segment = np.array(jnt_segment, dtype=np.intp)
+        self.nr_of_segments = n
+        self.nr_of_joints = len(jnt_segment)
+        self.folded = fold
+
+        self.base = np.identity(4)
+        self.seg_link = np.arange(n + 1)
+        self.seg_offset = np.empty((n + 1, 4, 4))
+        self.seg_offset[:] = np.identity(4)
+        if fold:
+            link_segment = jnt_segment
+            self.link_static = self.static[link_segment]
+            # product of the fixed segments from i to the end of its run
+            run = np.identity(4)
+            for i in reversed(range(n)):
+                if self.types[i] == FIXED:
+                    run = np.dot(self.static[i], run)
+                    self.seg_offset[i] = np.linalg.inv(run)
+                else:
+                    self.link_static[self.seg_joint[i]] = \
+                        np.dot(self.static[i], run)
+                    run = np.identity(4)
+            self.base = run
+            self.seg_link = np.searchsorted(self.jnt_segment,
+                                            np.arange(n + 1))
+        else:
+            link_segment = range(n)
+            self.link_static = self.static.copy()
+        self.link_types = self.types[link_segment]
+        self.link_scales = self.scales[link_segment]
+        self.link_joint = self.seg_joint[link_segment]
+        self.jnt_link = np.flatnonzero(self.link_joint >= 0)
+        self.nr_of_links = len(link_segment)
+        # plain python view of the link arrays for the per link loops
+        self._links = list(zip(self.link_types.tolist(),
+                               self.link_joint.tolist(),
+                               self.link_scales.tolist(),
+                               list(self.link_static)))
+
+    def type_name(self, i):
+        return _code_to_str[self.types[i]]
+
+    def link_pose(self, i, x):
+        '''Pose of link i moved by the joint value x.'''
+        type, n, scale, static = self._links[i]
+        if type == FIXED:
+            return static
+        m = static.copy()
+        x = scale * x
+        if type < TRANS_X:
+            a, b = _rot_rows[type]
+            c, s = cos(x), sin(x)
+            m[a] = c * static[a] - s * static[b]
+            m[b] = s * static[a] + c * static[b]
+        else:
+            m[type - TRANS_X] += x * static[3]
+        return m
+
+    def link_poses(self, q, out=None, start=0):
+        '''Base poses of all links and the end effector pose for q.
+
+        The result is an (links+1 x 4 x 4) array.  When out holds the
+        poses of a configuration that differs from q only in joints from
+        link start on, just the poses downstream of start are recomputed
+        into it.'''
+        if out is None:
+            out = np.empty((self.nr_of_links + 1, 4, 4))
+            start = 0
+        if start == 0:
+            out[0] = self.base
+        pose = out[start]
+        for i in range(start, self.nr_of_links):
+            n = self._links[i][1]
+            if n < 0:
+                pose = np.dot(pose, self._links[i][3])
+            else:
+                pose = np.dot(pose, self.link_pose(i, q[n]))
+            out[i + 1] = pose
+        return out
+
+    def update_link_poses(self, q, prev_q, out=None):
+        '''Return the link poses (see link_poses) for q, given out holding
+        those for the joint positions prev_q.  Only the poses downstream
+        of the first joint in which q and prev_q differ are recomputed
+        into out, and out is returned as is if they do not differ.'''
+        if out is None or prev_q is None or len(prev_q) != len(q):
+            return self.link_poses(q, out)
+        moved = np.flatnonzero(np.asarray(q) != np.asarray(prev_q))
+        if not len(moved):
+            return out
+        return self.link_poses(q, out, self.jnt_link[moved[0]])
+
+    def segment_poses(self, link_poses):
+        '''Expand link poses to the base poses of all segments.
+
+        Works on a single (links+1 x 4 x 4) array as well as on a stack
+        of them and returns (n+1 x 4 x 4) poses, the last one being the
+        end effector.'''
+        return np.matmul(link_poses[..., self.seg_link, :, :],
+                         self.seg_offset)
+
+    def poses(self, q):
+        '''Base poses of all segments and the end effector pose for q.'''
+        return self.segment_poses(self.link_poses(q))
+
+    def batch_poses(self, q, links=False):
+        '''Vectorized counterpart of poses for an (N x dof) array q.
+
+        Returns the (N x 4 x 4) end effector poses, or with links=True
+        the (N x n+1 x 4 x 4) poses of all segments.'''
+        q = np.asarray(q, dtype=np.float64).reshape(-1, self.nr_of_joints)
+        pose = np.empty((len(q), 4, 4))
+        pose[:] = self.base
+        if links:
+            out = np.empty((len(q), self.nr_of_links + 1, 4, 4))
+            out[:, 0] = pose
+        m = np.empty((len(q), 4, 4))
+        for i, (type, n, scale, static) in enumerate(self._links):
+            if type == FIXED:
+                pose = np.dot(pose, static)
+            else:
+                m[:] = static
+                x = scale * q[:, n, np.newaxis]
+                if type < TRANS_X:
+                    a, b = _rot_rows[type]
+                    c, s = np.cos(x), np.sin(x)
+                    m[:, a] = c * static[a] - s * static[b]
+                    m[:, b] = s * static[a] + c * static[b]
+                else:
+                    m[:, type - TRANS_X] += x * static[3]
+                pose = np.matmul(pose, m)
+            if links:
+                out[:, i + 1] = pose
+        if links:
+            return self.segment_poses(out)
+        return pose
+
+    def kdl_segments(self):
+        '''KDL segments of the links, preceded by a fixed base segment.'''
+        segments = make_segments(self.link_types, self.link_scales,
+                                 self.link_static)
+        if self.folded:
+            segments.insert(0, Segment(Joint(Joint.None),
+                                       array_to_frame(self.base)))
+        return segments
+
+class BatchFk(object):
+    '''Forward kinematics for many joint configurations at once.
+
+    Built from the same segment list as Robot, or from its compiled
+    ChainModel.'''
+
+    def __init__(self, segments):
+        if isinstance(segments, ChainModel):
+            self.model = segments
+        else:
+            self.model = ChainModel(segments)
+        self.dof = self.model.nr_of_joints
 
-_type_to_str = {
-    Joint.RotX: 'rot_x',
-    Joint.RotY: 'rot_y',
-    Joint.RotZ: 'rot_z',
-    Joint.TransX: 'trans_x',
-    Joint.TransY: 'trans_y',
-    Joint.TransZ: 'trans_z',
-    Joint.None: 'none'}
+    def __call__(self, q, links=False):
+        '''Return the end effector poses for the (N x dof) joint array q.
+
+        With links=True an (N x segments+1 x 4 x 4) array with the base
+        frame of every segment followed by the end effector is returned,
+        ordered like Robot.frames.  A single (dof,) configuration gives
+        results without the leading N axis.'''
+        single = np.ndim(q) == 1
+        poses = self.model.batch_poses(q, links)
+        if single:
+            return poses[0]
+        return poses
 
 class RJoint(object):
         
@@ -40,20 +311,22 @@ class RJoint(object):
         self.n = n
 
     def _get_frame(self):
-        frame = Frame()
-        #self.robot.fk_solver.JntToCart(self.robot.jnt_pos, frame)
-        self.robot.fk_solver.JntToCart(self.robot.jnt_pos, frame, self.i)
-        return frame
+        return self.robot.frames[self.i]
 
     frame = property(_get_frame)
 
+    def _get_pose(self):
+        return self.robot.poses[self.i]
+
+    pose = property(_get_pose)
+
     def _get_static_transform(self):
         return self.robot.segments[self.i].pose(0)
 
     static_transform = property(_get_static_transform)
 
     def _get_type(self):
-        return _type_to_str[self.robot.segments[self.i].getJoint().getType()]
+        return self.robot.model.type_name(self.i)
 
     type = property(_get_type)
 
@@ -67,48 +340,379 @@ class RJoint(object):
 
 class Robot(object):
 
-    def __init__(self, segments):
-        self.chain = Chain()
+    def __init__(self, segments, fold=True, limits_min=None, limits_max=None):
         self.segments = segments
-        for segment in segments:
+        self.model = ChainModel(segments, fold)
+        self.chain = Chain()
+        for segment in self.model.kdl_segments():
             self.chain.addSegment(segment)
         self.jnt_pos = JntArray(self.chain.getNrOfJoints())
         self.fk_solver = ChainFkSolverPos_recursive(self.chain)
         self.ikv_solver = ChainIkSolverVel_pinv(self.chain)
-        self.ik_solver = ChainIkSolverPos_NR(self.chain,
-                                             self.fk_solver,
-                                             self.ikv_solver)
+        self.limits_min = self.limits_max = None
+        if (limits_min is not None and limits_max is not None
+            and len(limits_min) and len(limits_max)):
+            self.limits_min = np.array(limits_min, dtype=np.float64)
+            self.limits_max = np.array(limits_max, dtype=np.float64)
 
         self.joints = []
         n = 0
-        for i, seg in enumerate(self.segments):
+        for i in range(len(segments)):
             self.joints.append(RJoint(self, i, n))
-            if seg.getJoint().getType() != Joint.None:
+            if self.model.types[i] != FIXED:
                 n += 1
 
+        self.version = 0
+        self._link_poses = None
+        self._link_poses_q = None
+        self._poses = None
+        self._poses_version = None
+        self._frames = None
+        self._frames_version = None
+        self._frame = None
+        self._frame_version = None
+        self.batch_fk = BatchFk(self.model)
+        self.ik_result = None
+        self.ik_cache = None
+        self.seed_index = None
+        self.seed_tries = 3
+        self.multistart = None
+        self.reach_map = None
+        self.rejected = 0
+        self.collision = None
+        self.collisions = 0
+        self.stream_tolerance = 1e-3
+        self.stream_damping = 1e-2
+        self.stream_error = 0.0
+        self.stream_steps = 0
+        self.stream_fallbacks = 0
+        if self.limits_min is not None:
+            self.set_ik('nr_jl')
+        else:
+            self.set_ik('nr')
+
     def __iter__(self):
         return iter(self.joints)
 
     def __getitem__(self, i):
         return self.joints[i]
 
+    def _get_q(self):
+        return np.array([self.jnt_pos[n] for n in range(self.jnt_pos.rows())])
+
+    def _set_q(self, q):
+        for n in range(self.jnt_pos.rows()):
+            self.jnt_pos[n] = q[n]
+
+    q = property(_get_q, _set_q)
+
+    def set_ik(self, name, **options):
+        '''Select the IK solver by name (see ik.solvers), passing options
+        such as eps, maxiter and budget on to it.'''
+        import ik
+        if name not in ik.solvers:
+            raise ValueError('unknown IK solver %r, not one of %s' %
+                             (name, ', '.join(sorted(ik.solvers))))
+        self.ik = ik.solvers[name](self, **options)
+        self.ik_name = name
+        if self.ik_cache is not None:
+            self.ik_cache.clear()
+
+    def joint_bounds(self):
+        '''Lower and upper bounds for sampling joint positions: the joint
+        limits, or -pi and pi without limits.'''
+        if self.limits_min is not None:
+            return self.limits_min, self.limits_max
+        dof = self.model.nr_of_joints
+        return -np.pi * np.ones(dof), np.pi * np.ones(dof)
+
+    def chain_digest(self):
+        '''Hex digest of the chain and the joint limits, for telling
+        whether data stored for a robot still matches it.'''
+        model = self.model
+        digest = hashlib.md5()
+        for a in (model.static, model.types, model.scales,
+                  self.limits_min, self.limits_max):
+            if a is not None:
+                digest.update(np.ascontiguousarray(a).tostring())
+        return digest.hexdigest()
+
+    def _get_link_poses(self):
+        '''Base poses of all links followed by the end effector pose.
+
+        The poses are an (links+1 x 4 x 4) array computed in a single
+        cumulative pass and cached until the joint positions change; only
+        the poses downstream of the first changed joint are recomputed.
+        The returned array must not be modified.'''
+        q = [self.jnt_pos[n] for n in range(self.jnt_pos.rows())]
+        if q != self._link_poses_q:
+            # update a copy, as callers may hold on to the previous poses
+            poses = None
+            if self._link_poses is not None:
+                poses = self._link_poses.copy()
+            self._link_poses = self.model.update_link_poses(
+                q, self._link_poses_q, poses)
+            self._link_poses_q = q
+            self.version += 1
+        return self._link_poses
+
+    link_poses = property(_get_link_poses)
+
+    def _get_poses(self):
+        '''Base poses of all segments followed by the end effector pose,
+        including the segments folded into links; for display.'''
+        link_poses = self.link_poses
+        if self._poses_version != self.version:
+            self._poses = self.model.segment_poses(link_poses)
+            self._poses_version = self.version
+        return self._poses
+
+    poses = property(_get_poses)
+
+    def _get_frames(self):
+        '''KDL frames of Robot.poses.'''
+        poses = self.poses
+        if self._frames_version != self.version:
+            self._frames = [array_to_frame(m) for m in poses]
+            self._frames_version = self.version
+        return self._frames
+
+    frames = property(_get_frames)
+
     def _get_frame(self):
-        frame = Frame()
-        self.fk_solver.JntToCart(self.jnt_pos, frame)
-        return frame
+        pose = self.link_poses[-1]
+        if self._frame_version != self.version:
+            self._frame = array_to_frame(pose)
+            self._frame_version = self.version
+        return self._frame
 
     frame = property(_get_frame)
 
-    def try_move(self, frame):
-        #kdl_frame = Frame()
-        #for i, j in [(i, j) for i in range(4) for j in range(4)]:
-        #    kdl_frame[i, j] = frame[i, j]
-        jnt_pos = JntArray(self.jnt_pos)
+    def _check_collision(self, result):
+        if (result.success and self.collision is not None
+            and self.collision.collides(result.q)):
+            result.success = False
+            self.collisions += 1
+        return result
+
+    def solve(self, target, seed=None):
+        '''Solve the IK for the 4x4 target pose starting from seed (the
+        current joint positions by default) without moving the robot.
 
-        if self.ik_solver.CartToJnt(jnt_pos, frame, jnt_pos) == 0:
-            self.jnt_pos = jnt_pos
+        With an ik_cache (ik.IKCache) repeated requests for solved targets
+        are answered from the cache.  With a seed_index (ik.SeedIndex) a
+        failed solve is retried from the nearest sampled configurations,
+        and with a multistart (ik.MultiStartIK) the retries run in
+        parallel.  Targets outside a reach_map (reach.ReachabilityMap)
+        fail without solving, and with a collision checker
+        (collision.CollisionChecker) solutions in collision count as
+        failures.'''
+        if seed is None:
+            seed = self.q
+        if self.reach_map is not None and not self.reach_map.reachable(target):
+            import ik
+            self.rejected += 1
+            return ik.IKResult(np.array(seed), False, 0, np.inf, 0.0)
+        if self.ik_cache is not None:
+            result = self.ik_cache.get(seed, target)
+            if result is not None:
+                return result
+        result = self._check_collision(self.ik.solve(seed, target))
+        if not result.success:
+            seeds = []
+            if self.seed_index is not None:
+                seeds = list(self.seed_index.nearest(target, self.seed_tries))
+            if self.multistart is not None:
+                retry = self._check_collision(self.multistart.solve(target,
+                                                                    seeds))
+                retry.iterations += result.iterations
+                retry.time += result.time
+                if retry.success or retry.residual < result.residual:
+                    result = retry
+            elif seeds:
+                iterations, elapsed = result.iterations, result.time
+                for q in seeds:
+                    retry = self._check_collision(self.ik.solve(q, target))
+                    iterations += retry.iterations
+                    elapsed += retry.time
+                    if retry.success or retry.residual < result.residual:
+                        result = retry
+                    if retry.success:
+                        break
+                result.iterations, result.time = iterations, elapsed
+        # failures may only be out of budget, so a later solve may succeed
+        if self.ik_cache is not None and result.success:
+            self.ik_cache.put(seed, target, result)
+        return result
+
+    def stream_move(self, frame):
+        '''Move the end effector towards frame with a single damped least
+        squares step from the current configuration, for small
+        incremental motions such as drags.  Only when the error left
+        after the step exceeds stream_tolerance, or the step ends in
+        collision, is the position IK of try_move run; if that fails too
+        the robot does not move.'''
+        import ik
+        target = frame_to_array(frame)
+        q = self.q
+        poses = self.link_poses
+        step = ik.damped_step(ik.jacobian(self.model, poses),
+                              ik.pose_error(poses[-1], target),
+                              self.stream_damping)
+        if self.limits_min is not None:
+            self.q = np.clip(q + step, self.limits_min, self.limits_max)
+        else:
+            self.q = q + step
+        e = ik.pose_error(self.link_poses[-1], target)
+        self.stream_error = np.sqrt(np.dot(e, e))
+        self.stream_steps += 1
+        if self.stream_error <= self.stream_tolerance and (
+            self.collision is None or not self.collision.collides()):
+            return True
+        self.stream_fallbacks += 1
+        self.q = q
+        return self.try_move(frame)
+
+    def solve_path(self, targets, seed=None, chunks=1, jump_ratio=4.0):
+        '''Solve a sequence of target poses (KDL frames or 4x4 arrays)
+        in order, seeding each from the previous solution, without moving
+        the robot.  Returns the (N x dof) joint positions and a boolean
+        array telling which points were reached; as with solve, points in
+        collision or outside the reach_map count as not reached.
+
+        With a multistart pool and chunks > 1 the path is split into
+        chunks solved in parallel.  The first points of the chunks are
+        solved in sequence beforehand to seed them.  A chunk whose first
+        step is more than jump_ratio times the largest step next to it
+        (in any joint) is solved again serially from where the previous
+        chunk ended.'''
+        import ik
+        targets = list(targets)
+        for i, t in enumerate(targets):
+            if not isinstance(t, np.ndarray):
+                targets[i] = frame_to_array(t)
+        if seed is None:
+            seed = self.q
+        if chunks <= 1 or self.multistart is None or len(targets) < 2 * chunks:
+            q, ok = ik.solve_path(self.ik, targets, seed)
+            return q, self._path_status(targets, q, ok)
+        bounds = np.linspace(0, len(targets), chunks + 1).astype(int)
+        # continue from chunk to chunk, as a serial solve would
+        seeds = [seed]
+        for b in bounds[1:-1]:
+            result = self.ik.solve(seeds[-1], targets[b])
+            if result.success:
+                seeds.append(result.q)
+            else:
+                seeds.append(seeds[-1])
+        parts = self.multistart.solve_paths(seeds, [targets[a:b] for a, b in
+                                                    zip(bounds[:-1],
+                                                        bounds[1:])])
+        q = np.vstack([part[0] for part in parts])
+        ok = np.concatenate([part[1] for part in parts])
+        for a, b in zip(bounds[1:-1], bounds[2:]):
+            join = np.abs(q[a] - q[a - 1]).max()
+            after = np.abs(q[a + 1] - q[a]).max()
+            before = 0.0
+            if a > 1:
+                before = np.abs(q[a - 1] - q[a - 2]).max()
+            if join > jump_ratio * max(before, after, 1e-3):
+                q[a:b], ok[a:b] = ik.solve_path(self.ik, targets[a:b],
+                                                q[a - 1])
+        return q, self._path_status(targets, q, ok)
+
+    def _path_status(self, targets, q, ok):
+        if self.reach_map is not None:
+            reachable = np.array([self.reach_map.reachable(t)
+                                  for t in targets])
+            self.rejected += (ok & ~reachable).sum()
+            ok &= reachable
+        if self.collision is not None:
+            free = ~self.collision.batch_check(q)
+            self.collisions += (ok & ~free).sum()
+            ok &= free
+        return ok
+
+    def try_move(self, frame):
+        '''Move the end effector to frame using Robot.solve; the joint
+        positions only change on success.  The statistics of the solve
+        are kept in ik_result.'''
+        self.ik_result = self.solve(frame_to_array(frame))
+        if self.ik_result.success:
+            self.q = self.ik_result.q
             return True
         else:
             return False
 
-__all__ = ['Robot']
+__all__ = ['Robot', 'ChainModel', 'BatchFk', 'frame_to_array', 'array_to_frame',
+           'make_segments']
+
+_robodefs = ['robodef.py', 'lbr3.py', 'b21_left.py', 'b21_right.py',
+             'def_b21_cam.py', 'exodef.py']
+
+def _kdl_poses(fk, n, q):
+    '''Base poses of the n segments and the end effector pose by KDL.'''
+    jnt = JntArray(len(q))
+    for i, v in enumerate(q):
+        jnt[i] = v
+    poses = np.empty((n + 1, 4, 4))
+    frame = Frame()
+    for i in range(n + 1):
+        if fk.JntToCart(jnt, frame, i) < 0:
+            raise RuntimeError('JntToCart failed')
+        poses[i] = frame_to_array(frame)
+    return poses
+
+def _check(path, samples=50, tol=1e-9):
+    import imp
+    import os
+    name = os.path.splitext(os.path.basename(path))[0]
+    robodef = imp.load_source('robodef_' + name, path)
+    segments = robodef.segments
+    limits_min = getattr(robodef, 'limits_min', None)
+    limits_max = getattr(robodef, 'limits_max', None)
+    chain = Chain()
+    for segment in segments:
+        chain.addSegment(segment)
+    fk = ChainFkSolverPos_recursive(chain)
+    robot = Robot(segments, True, limits_min, limits_max)
+    unfolded = Robot(segments, False, limits_min, limits_max)
+    dof = robot.model.nr_of_joints
+    lo, hi = robot.joint_bounds()
+    q = np.random.RandomState(0).uniform(lo, hi, (samples, dof))
+    batch = robot.batch_fk(q, links=True)
+    errors = {}
+    def compare(check, poses, reference):
+        error = np.abs(poses - reference).max()
+        errors[check] = max(errors.get(check, 0.0), error)
+    for k in range(samples):
+        reference = _kdl_poses(fk, len(segments), q[k])
+        compare('batch', batch[k], reference)
+        robot.q = q[k]
+        compare('poses', robot.poses, reference)
+        compare('frame', frame_to_array(robot.frame), reference[-1])
+        unfolded.q = q[k]
+        compare('unfolded', unfolded.poses, reference)
+        # a single joint change recomputes only downstream of it
+        if dof:
+            moved = q[k].copy()
+            moved[k % dof] += 0.3
+            robot.q = moved
+            compare('incremental', robot.poses,
+                    _kdl_poses(fk, len(segments), moved))
+    failed = [check for check in sorted(errors) if errors[check] > tol]
+    print '%-16s %2d joints, max error %.2g: %s' % (
+        name, dof, max(errors.values()),
+        failed and 'FAILED (%s)' % ', '.join(failed) or 'ok')
+    return not failed
+
+if __name__ == '__main__':
+    import os
+    import sys
+    paths = sys.argv[1:]
+    if not paths:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        paths = [os.path.join(directory, name) for name in _robodefs]
+    results = [_check(path) for path in paths]
+    if not all(results):
+        sys.exit(1)
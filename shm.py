@@ -0,0 +1,317 @@
+# shm.py -- Shared memory transport for joint vectors
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+#
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+"""Shared memory transport
+
+Every endpoint is a ring buffer in a file mapped by both peers (in
+/dev/shm where available), written by one process and read by any
+number of others without locks.  The file is a sequence of
+little-endian 64 bit words:
+
+    magic 'RVSHM001', size, slots, write sequence number,
+    slots times: sequence number, time (float64), size float64 values
+
+The writer of message n (counting from 1) clears the sequence number of
+slot n % slots, fills in the time and the values, sets the sequence
+number to n and then publishes n as the write sequence number.  A reader
+copies a slot and keeps the copy only if the slot's sequence number was
+n both before and after.
+
+Run as
+
+    python shm.py [--rate <hz>] [--seconds <s>] [<prefix>]
+
+to act as a peer of ``roboview --shm'': it sends a sine wave to qin and
+reports the rate and round trip latency of the positions on qout.
+"""
+
+__all__ = ['ShmRing', 'ShmInput', 'ShmOutput', 'ShmTransport',
+           'default_dir']
+
+from ports import LATEST, ALL
+from timing import LatencyStats
+import numpy as np
+import errno
+import mmap
+import os
+import tempfile
+import time
+
+_magic = np.frombuffer('RVSHM001', dtype='<u8')[0]
+_header = 4 # words
+
+def default_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+class ShmRing(object):
+    '''Ring buffer of slots vectors of size float64 values in the file
+    at path, created if it does not exist.  An existing file with another
+    layout raises IOError, as replacing it would leave peers that mapped
+    it talking to a file nobody else sees.'''
+
+    def __init__(self, path, size, slots=64):
+        words = _header + slots * (2 + size)
+        self.created = False
+        if not os.path.exists(path):
+            self.created = self._create(path, words, size, slots)
+        self._check(path, size, slots)
+        self.path = path
+        self.size = size
+        self.slots = slots
+        f = open(path, 'r+b')
+        try:
+            self._map = mmap.mmap(f.fileno(), words * 8)
+        finally:
+            f.close()
+        self.words = np.frombuffer(self._map, dtype='<u8')
+        self.values = self.words.view('<f8')
+        self.stride = 2 + size
+
+    @staticmethod
+    def _create(path, words, size, slots):
+        '''Create the file unless a peer does so first; returns whether
+        this process created it.'''
+        # write under a temporary name so peers never map a partly
+        # initialized file, then link, which never replaces a file
+        tmp = '%s.%d' % (path, os.getpid())
+        init = np.zeros(words, dtype='<u8')
+        init[:3] = _magic, size, slots
+        init.tofile(tmp)
+        try:
+            os.link(tmp, path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            os.unlink(tmp)
+        return True
+
+    @staticmethod
+    def _check(path, size, slots):
+        header = np.fromfile(path, dtype='<u8', count=3)
+        if len(header) != 3 or header[0] != _magic:
+            raise IOError('%s is not a shared memory ring' % path)
+        if (header[1] != size or header[2] != slots or
+            os.path.getsize(path) != 8 * (_header + slots * (2 + size))):
+            raise IOError('%s holds %d slots of %d values, not %d of %d '
+                          '(remove it if no peer uses it)' %
+                          (path, header[2], header[1], slots, size))
+
+    def _get_seq(self):
+        return int(self.words[3])
+
+    seq = property(_get_seq)
+
+    def write(self, q, stamp=None):
+        n = self.seq + 1
+        base = _header + (n % self.slots) * self.stride
+        self.words[base] = 0
+        if stamp is None:
+            stamp = time.time()
+        self.values[base + 1] = stamp
+        self.values[base + 2:base + self.stride] = q
+        self.words[base] = n
+        self.words[3] = n
+        return n
+
+    def read(self, n):
+        '''Return (time, values) of message n, or None if it has been
+        overwritten or is being written.'''
+        base = _header + (n % self.slots) * self.stride
+        if self.words[base] != n:
+            return None
+        stamp = self.values[base + 1]
+        q = self.values[base + 2:base + self.stride].copy()
+        if self.words[base] != n:
+            return None
+        return stamp, q
+
+    def close(self, remove=False):
+        '''Unmap the ring, and with remove delete the file if this
+        process created it.'''
+        self.words = self.values = None
+        self._map.close()
+        if remove and self.created and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class ShmInput(object):
+    '''Shared memory counterpart of ports.JointInput, with the same
+    modes, counters and latency statistics, except that messages
+    overwritten by the writer before they could be read count as
+    stale.'''
+
+    def __init__(self, path, size, mode=LATEST, max_batch=16, slots=64):
+        self.ring = ShmRing(path, size, slots)
+        self.name = path
+        self.size = size
+        self.mode = mode
+        self.max_batch = max_batch
+        self.last = self.ring.seq
+        self.received = 0
+        self.dropped = 0
+        self.stale = 0
+        self.invalid = 0
+        self.latency = LatencyStats()
+        self.stamp = None
+
+    def _read(self, first, last):
+        vectors = []
+        now = time.time()
+        for n in range(first, last + 1):
+            message = self.ring.read(n)
+            if message is None:
+                self.stale += 1
+                self.latency.skip(n)
+                continue
+            sent, q = message
+            self.stamp = n, sent
+            self.latency.add(n, sent, now)
+            vectors.append(q)
+        return vectors
+
+    def read(self):
+        last = self.ring.seq
+        count = last - self.last
+        if count <= 0:
+            self.last = last
+            if self.mode == LATEST:
+                return None
+            return []
+        self.received += count
+        keep = self.mode == LATEST and 1 or self.max_batch
+        # the writer may already have overwritten the oldest slots
+        keep = min(keep, self.ring.slots - 1)
+        skipped = max(count - keep, 0)
+        if self.mode == LATEST:
+            self.dropped += skipped
+        else:
+            self.stale += skipped
+        # skipped messages count as dropped or stale, not lost
+        self.latency.skip(self.last + skipped)
+        vectors = self._read(self.last + 1 + skipped, last)
+        self.last = last
+        if self.mode == LATEST:
+            if vectors:
+                return vectors[-1]
+            return None
+        return vectors
+
+    def __repr__(self):
+        return ('%s(received=%d, dropped=%d, stale=%d, invalid=%d, %r)' %
+                (self.name, self.received, self.dropped, self.stale,
+                 self.invalid, self.latency))
+
+class ShmOutput(object):
+    '''Shared memory counterpart of ports.JointOutput.'''
+
+    def __init__(self, path, size, slots=64):
+        self.ring = ShmRing(path, size, slots)
+
+    def write(self, q, stamp=None):
+        '''Like JointOutput.write, except that the ring numbers the
+        messages itself; only the time of stamp is kept.'''
+        if stamp is None:
+            self.ring.write(q)
+        else:
+            self.ring.write(q, stamp[1])
+
+class ShmTransport(object):
+    '''Opens endpoints as shared memory rings in directory (default_dir()
+    by default), one file per endpoint named after the prefix and the
+    port.  close() removes the files the transport created, so peers
+    still running then have to be restarted.'''
+
+    def __init__(self, prefix='', directory=None, slots=64):
+        self.prefix = prefix
+        self.directory = directory or default_dir()
+        self.slots = slots
+        self.rings = []
+
+    def path(self, name):
+        return os.path.join(self.directory, 'roboview%s.%s' %
+                            (self.prefix.replace('/', '_'), name))
+
+    def input(self, name, size, mode=LATEST):
+        port = ShmInput(self.path(name), size, mode, slots=self.slots)
+        self.rings.append(port.ring)
+        return port
+
+    def output(self, name, size):
+        port = ShmOutput(self.path(name), size, self.slots)
+        self.rings.append(port.ring)
+        return port
+
+    def close(self):
+        for ring in self.rings:
+            ring.close(True)
+        self.rings = []
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+    rate = 1000.0
+    seconds = 5.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+                                   ['help', 'rate=', 'seconds='])
+    except getopt.GetoptError:
+        opts, args = [('--help', '')], []
+    for opt, val in opts:
+        if opt == '--help':
+            print __doc__
+            sys.exit(0)
+        elif opt == '--rate':
+            rate = float(val)
+        elif opt == '--seconds':
+            seconds = float(val)
+    if len(args) > 1:
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+    transport = ShmTransport(args and args[0] or '')
+    path = transport.path('qout')
+    if not os.path.exists(path):
+        print >>sys.stderr, 'no', path, '(start roboview --shm first)'
+        sys.exit(1)
+    size = int(np.fromfile(path, dtype='<u8', count=2)[1])
+    qin = transport.output('qin', size)
+    qout = transport.input('qout', size, ALL)
+    sent = {}
+    latencies = []
+    start = time.time()
+    k = 0
+    while time.time() - start < seconds:
+        q = np.zeros(size)
+        q[0] = 0.5 * np.sin(k / rate)
+        sent[q[0]] = time.time()
+        qin.write(q)
+        for q in qout.read():
+            if q[0] in sent:
+                latencies.append(time.time() - sent.pop(q[0]))
+        k += 1
+        time.sleep(max(start + k / rate - time.time(), 0))
+    elapsed = time.time() - start
+    print 'sent %d vectors at %.1f Hz' % (k, k / elapsed)
+    print 'qout:', qout
+    transport.close()
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        print ('round trip of %d vectors: median %.3f ms, p99 %.3f ms, '
+               'max %.3f ms' % (len(latencies), np.median(latencies),
+                                np.percentile(latencies, 99),
+                                latencies.max()))
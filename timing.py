@@ -0,0 +1,223 @@
+# timing.py -- Per phase loop timing statistics
+# -*- coding: utf-8 -*-
+#
+# This file is part of RoboView.
+#
+# RoboView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RoboView is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details. You should have received a
+# copy of the GNU General Public License along with PyPlayerCGen.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['monotonic', 'Histogram', 'PhaseTimer', 'NullTimer',
+           'LatencyStats']
+
+from math import log10
+import ctypes
+import ctypes.util
+import time
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    CLOCK_MONOTONIC = 1
+    ts = _Timespec()
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+# seconds on a clock that is never set back, or time.time where there is
+# no such clock
+monotonic = getattr(time, 'monotonic', None) or _clock_gettime() or time.time
+
+class Histogram(object):
+    '''Durations from 100ns to 10s in logarithmic bins, bins_per_decade
+    to a decade; longer and shorter ones go to the outermost bins.'''
+
+    lowest = -7 # log10 [s]
+    decades = 8
+
+    def __init__(self, bins_per_decade=20):
+        self.bins_per_decade = bins_per_decade
+        self.counts = [0] * (self.decades * bins_per_decade)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        if duration > 0:
+            i = int((log10(duration) - self.lowest) * self.bins_per_decade)
+            i = min(max(i, 0), len(self.counts) - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, p):
+        '''Upper edge of the bin holding the p-th percentile [s].'''
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                break
+        return min(10 ** (self.lowest + (i + 1.0) / self.bins_per_decade),
+                   self.max)
+
+    def mean(self):
+        return self.count and self.total / self.count
+
+    def clear(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+class PhaseTimer(object):
+    '''Times the phases of a loop meant to run every period [s].
+
+    Call begin() at the start of every cycle and mark(name) at the end of
+    each phase; the time since the previous mark (or begin) goes to the
+    histogram of that phase.  The cycle histogram holds the time between
+    consecutive begin() calls, and cycles busy for longer than period
+    count as overruns.'''
+
+    def __init__(self, period=None):
+        self.period = period
+        self.phases = {}
+        self.order = []
+        self.cycle = Histogram()
+        self.overruns = 0
+        self.started = None
+        self._begin = None
+        self._last = None
+
+    def begin(self):
+        now = monotonic()
+        if self._begin is None:
+            self.started = now
+        else:
+            self.cycle.add(now - self._begin)
+            busy = self._last - self._begin
+            if self.period is not None and busy > self.period:
+                self.overruns += 1
+        self._begin = self._last = now
+
+    def mark(self, name):
+        now = monotonic()
+        try:
+            hist = self.phases[name]
+        except KeyError:
+            hist = self.phases[name] = Histogram()
+            self.order.append(name)
+        hist.add(now - self._last)
+        self._last = now
+
+    def frequency(self):
+        '''Effective loop frequency since the first cycle [Hz].'''
+        if not self.cycle.count:
+            return 0.0
+        return self.cycle.count / (self._begin - self.started)
+
+    def report(self, title='loop'):
+        '''Return the statistics as text, times in ms.'''
+        lines = ['%s: %d cycles at %.1f Hz, %d overruns' %
+                 (title, self.cycle.count, self.frequency(), self.overruns),
+                 '  %-10s %8s %8s %8s %8s %8s %8s' %
+                 ('phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        hists = [(name, self.phases[name]) for name in self.order]
+        for name, hist in hists + [('cycle', self.cycle)]:
+            lines.append('  %-10s %8d %8.3f %8.3f %8.3f %8.3f %8.3f' %
+                         (name, hist.count, hist.mean() * 1000,
+                          hist.percentile(50) * 1000,
+                          hist.percentile(90) * 1000,
+                          hist.percentile(99) * 1000, hist.max * 1000))
+        return '\n'.join(lines)
+
+    def clear(self):
+        for hist in self.phases.values():
+            hist.clear()
+        self.cycle.clear()
+        self.overruns = 0
+        self._begin = None
+
+class NullTimer(object):
+    '''Stand-in for a PhaseTimer when timing is off.'''
+
+    def begin(self):
+        pass
+
+    def mark(self, name):
+        pass
+
+    def report(self, title='loop'):
+        return '%s: timing is off (see --timing)' % title
+
+    def clear(self):
+        pass
+
+class LatencyStats(object):
+    '''Latency of messages stamped with a sequence number and the send
+    time (time.time of the sender) when received.
+
+    jitter is the running mean deviation of the latency between
+    consecutive messages (as in RFC 3550), and lost counts the gaps in
+    the sequence numbers.'''
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.jitter = 0.0
+        self.lost = 0
+        self._last = None
+        self._seq = None
+
+    def add(self, seq, sent, received=None):
+        if received is None:
+            received = time.time()
+        latency = received - sent
+        self.latency.add(latency)
+        if self._last is not None:
+            self.jitter += (abs(latency - self._last) - self.jitter) / 16.0
+        self._last = latency
+        if self._seq is not None and seq > self._seq + 1:
+            self.lost += seq - self._seq - 1
+        self._seq = seq
+
+    def skip(self, seq):
+        '''Account for message seq as delivered but not read, so that it
+        does not count as lost.'''
+        if self._seq is None or seq > self._seq:
+            self._seq = seq
+
+    def __repr__(self):
+        hist = self.latency
+        return ('latency(count=%d, p50=%.3fms, p99=%.3fms, max=%.3fms, '
+                'jitter=%.3fms, lost=%d)' % (
+                    hist.count, hist.percentile(50) * 1000,
+                    hist.percentile(99) * 1000, hist.max * 1000,
+                    self.jitter * 1000, self.lost))
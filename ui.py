@@ -20,7 +20,7 @@
 # copy of the GNU General Public License along with PyPlayerCGen.  If
 # not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['RobotWidget']
+__all__ = ['RobotWidget', 'ReachabilityWidget', 'ObstacleWidget']
 
 from display import *
 from math import pi, sqrt, acos, sin
@@ -215,6 +215,26 @@ class NoneJointWidget(object):
         for i, j in [(i, j) for i in range(3) for j in range(4)]:
             self.frame[i, j] = frame[i, j]
 
+class FixedMarkerWidget(object):
+    '''Lightweight stand-in for a fixed segment folded into a link: just
+    the link cylinder and, optionally, a small cube.'''
+
+    def __init__(self, frame, joint=None, marker=True):
+        self.frame = frame
+        self.joint = joint
+        self.marker = marker
+
+    def add_to(self, display):
+        t = self.frame
+        if self.marker:
+            display.add(id(self), t(joint_cube), opacity=.5)
+        if self.joint is not None:
+            display.add(None, t(make_link_cylinder(self.joint)), opacity=.3)
+
+    def update(self, frame, value):
+        for i, j in [(i, j) for i in range(3) for j in range(4)]:
+            self.frame[i, j] = frame[i, j]
+
 class EndEffectorWidget(object):
 
     def __init__(self, frame, joint=None):
@@ -256,11 +276,15 @@ class EndEffectorWidget(object):
 
 class RobotWidget(object):
 
-    def __init__(self, robot):
+    def __init__(self, robot, fixed_markers=True):
         self.joint_widgets = []
         joints = [j for j in robot]
         for j_prev, j in zip([None] + joints[:-1], joints):
-            if j.type == 'none':
+            if j.type == 'none' and robot.model.folded:
+                self.joint_widgets.append(FixedMarkerWidget(MatrixTransform(),
+                                                            j_prev,
+                                                            fixed_markers))
+            elif j.type == 'none':
                 self.joint_widgets.append(NoneJointWidget(MatrixTransform(), j_prev))
             elif j.type in ('rot_x', 'rot_y', 'rot_z'):
                 self.joint_widgets.append(JointWidget(MatrixTransform(),
@@ -278,3 +302,50 @@ class RobotWidget(object):
     def update(self, frames):
         for f, widget in zip(frames, self.joint_widgets + [self.ef_widget]):
             widget.update(f)
+
+class ReachabilityWidget(object):
+    '''Translucent overlay of the reachable voxels of a reachability
+    map.'''
+
+    def __init__(self, reach_map):
+        self.reach_map = reach_map
+        self.actor = None
+
+    def add_to(self, display):
+        self.actor = display.add(None, point_cloud(self.reach_map.voxels()),
+                                 color=(.2, .6, 1), opacity=.15)
+        self.actor.GetProperty().SetPointSize(4)
+        self.actor.SetVisibility(False)
+
+    def toggle(self):
+        self.actor.SetVisibility(not self.actor.GetVisibility())
+
+class ObstacleWidget(object):
+    '''Display of a collision obstacle: a capsule (spheres being capsules
+    of zero length) or an axis aligned box.'''
+
+    def __init__(self, obstacle):
+        self.obstacle = obstacle
+
+    def add_to(self, display):
+        o = self.obstacle
+        color = (.8, .3, .3)
+        if hasattr(o, 'radius'):
+            d = 2 * o.radius
+            for x, y, z in (o.a, o.b):
+                display.add(None, translate(x, y, z, scale(d, d, d, sphere)),
+                            color=color, opacity=.5)
+            v = vec_sub(o.b, o.a)
+            if vec_abs(v) > 0:
+                frame = MatrixTransform()
+                make_vector_x_base(frame, v)
+                for i in range(3):
+                    frame[i, 3] = o.a[i]
+                display.add(None, frame(translate(.5, 0, 0, scale(1, d, d,
+                                        rotate_z(-pi/2, cylinder)))),
+                            color=color, opacity=.5)
+        else:
+            x, y, z = vec_s(vec_add(o.lo, o.hi), .5)
+            dx, dy, dz = vec_sub(o.hi, o.lo)
+            display.add(None, translate(x, y, z, scale(dx, dy, dz, cube)),
+                        color=color, opacity=.5)